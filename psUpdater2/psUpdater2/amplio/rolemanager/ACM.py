@@ -4,6 +4,7 @@ from pathlib import Path
 from typing import Union
 
 ACM_PREFIX = 'ACM-'
+_ACM_PREFIX_LEN = len(ACM_PREFIX)
 DROPBOX_PATH = expanduser('~/Dropbox (Amplio)')
 
 
@@ -15,18 +16,22 @@ def canonical_acm_path(acm: str, dropbox:Union[bytes, str, os.PathLike]=DROPBOX_
     return Path(dropbox, canonical_acm_name(acm))
 
 
+def _last_component(name: str) -> str:
+    # The part after the last path separator; what os.path.split(name)[1] gives, without building the head.
+    name = name.rpartition(os.sep)[2]
+    if os.altsep:
+        name = name.rpartition(os.altsep)[2]
+    return name
+
+
 def canonical_acm_name(acm: str) -> str:
     """
     Given an ACM or Program name, return a canonicalized ACM name (upper case, with ACM- prefix).
     """
     if acm is None:
         return None
-    acm = acm.upper()
-    _, acm_name = os.path.split(acm)
-    acm_name = acm_name.upper()
-    if not acm_name.startswith(ACM_PREFIX):
-        acm_name = ACM_PREFIX + acm_name
-    return acm_name
+    acm_name = _last_component(acm).upper()
+    return acm_name if acm_name.startswith(ACM_PREFIX) else ACM_PREFIX + acm_name
 
 
 def canonical_acm_program_name(acmdir: str) -> str:
@@ -35,8 +40,5 @@ def canonical_acm_program_name(acmdir: str) -> str:
     """
     if acmdir is None:
         return None
-    _, program_name = os.path.split(acmdir)
-    program_name = program_name.upper()
-    if program_name.startswith(ACM_PREFIX):
-        program_name = program_name[4:]
-    return program_name
+    program_name = _last_component(acmdir).upper()
+    return program_name[_ACM_PREFIX_LEN:] if program_name.startswith(ACM_PREFIX) else program_name
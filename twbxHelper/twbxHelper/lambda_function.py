@@ -1,30 +1,40 @@
-import binascii
-import csv
+"""
+Tableau Workbook helper.
+
+An AWS Lambda function to upload .twbx files and "teaser" .pngs, and to server those
+files to a web page (eg, in the dashboard).
+
+Functions available:
+
+
+
+"""
+import base64
 import datetime
-import distutils.util
+import hashlib
 import io
 import json
+import logging
 import os
+import threading
 import time
-import traceback
-import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Union, Tuple
+from typing import Dict, FrozenSet, Iterator, NamedTuple, Union, Tuple
 
 import boto3
 from amplio.rolemanager import manager as role_manager
 
-"""
-Tableau Workbook helper.
-
-An AWS Lambda function to upload .twbx files and "teaser" .pngs, and to server those
-files to a web page (eg, in the dashboard).
-
-Functions available:
-
+# orjson is much faster than json, but isn't part of the standard Lambda runtime; use it if it is packaged.
+try:
+    import orjson
 
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    _dumps = json.dumps
 
-"""
 # noinspection DuplicatedCode
 
 WORKBOOK_SUFFIX = '.twbx'
@@ -43,25 +53,79 @@ STATUS_ACCESS_DENIED = 'Access denied'
 STATUS_MISSING_PARAMETER = 'Missing parameter'
 STATUS_BAD_FILE_TYPE = 'Bad file type'
 
-s3 = boto3.client('s3')
+# Per-request diagnostics are logged at DEBUG; set LOG_LEVEL=DEBUG in the function's environment to see them.
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# The S3 client is created on first use; building it loads the service model and credential providers, which
+# actions that never touch S3 (eg, 'ping', or a request with a missing parameter) shouldn't pay for.
+# The lock is needed because the first use may come from several _executor threads at once, and creating clients
+# from boto3's default session isn't thread safe.
+_s3 = None
+_s3_lock = threading.Lock()
+
+
+def _get_s3():
+    global _s3
+    if _s3 is None:
+        with _s3_lock:
+            if _s3 is None:
+                _s3 = boto3.client('s3')
+    return _s3
+
+
+# Shared by the request handlers to overlap independent S3 and DynamoDB round trips. Created once per container,
+# so warm invocations don't pay for starting threads.
+_executor = ThreadPoolExecutor(max_workers=3)
 
 stats_bucket = 'dashboard-lb-stats'
 
-role_manager.open_tables()
+# The roles tables are opened on the first authorization check, so that actions that don't need them (eg, 'ping')
+# don't pay for opening them.
+_tables_opened = False
 
 ADMIN_REQUIRED_ACTIONS = {'refresh-twbx', 'upload-twbx-template', 'remove-previews'}
 
+# The strings accepted as true or false by _bool_arg; the same set that distutils.util.strtobool accepted.
+_BOOL_STRINGS = {'y': True, 'yes': True, 't': True, 'true': True, 'on': True, '1': True,
+                 'n': False, 'no': False, 'f': False, 'false': False, 'off': False, '0': False}
+
+
+# Roles are cached in a warm container for a short time, since the same user tends to make several requests for
+# the same program. A change to a user's roles is therefore seen within ROLES_CACHE_TTL seconds.
+ROLES_CACHE_TTL = 60
+_roles_cache: Dict[Tuple[str, str], Tuple[float, FrozenSet[str]]] = {}
+
+
+def _cached_roles(email: str, program: str) -> FrozenSet[str]:
+    """
+    Gets the user's roles in the program, as a set, so that checking for a role is a lookup rather than a substring
+    search of the comma separated string.
+    """
+    now = time.monotonic()
+    cached = _roles_cache.get((email, program))
+    if cached is not None and now - cached[0] < ROLES_CACHE_TTL:
+        return cached[1]
+    roles_str = role_manager.get_roles_for_user_in_program(email, program)
+    roles = frozenset(roles_str.split(',')) - {''} if roles_str else frozenset()
+    _roles_cache[(email, program)] = (now, roles)
+    return roles
+
 
 class Authorizer:
     # noinspection PyUnusedLocal
     @staticmethod
     def is_authorized(claims, action, program: str = None):
+        global _tables_opened
+        if not _tables_opened:
+            role_manager.open_tables()
+            _tables_opened = True
         email = claims.get('email')
-        roles_str = role_manager.get_roles_for_user_in_program(email, program)
-        print('Roles for {} in {}: {}'.format(email, program, roles_str))
+        roles = _cached_roles(email, program)
+        logger.debug('Roles for %s in %s: %s', email, program, roles)
         if action in ADMIN_REQUIRED_ACTIONS:
-            return role_manager.Roles.PM_ROLE in roles_str and role_manager.Roles.ADMIN_ROLE in roles_str
-        return roles_str is not None and len(roles_str) > 0
+            return role_manager.Roles.PM_ROLE in roles and role_manager.Roles.ADMIN_ROLE in roles
+        return bool(roles)
 
 
 authorizer: Authorizer = Authorizer()
@@ -73,42 +137,50 @@ def _bool_arg(arg, default=False):
         return arg
     elif arg is None:
         return default
-    try:
-        return bool(distutils.util.strtobool(arg))
-    except ValueError:
-        return default
+    return _BOOL_STRINGS.get(str(arg).strip().lower(), default)
+
+
+def program_prefix(program: str) -> str:
+    return f'twbx/{program}/'
 
 
+# All of a program's keys are built here (and memoized), rather than formatted ad hoc at each use.
+@lru_cache(maxsize=256)
 def object_key(program: str, flavor: str, filename=None) -> str:
     if flavor == 'preview' and filename is not None:
-        return f'twbx/{program}/{filename}'
+        return program_prefix(program) + filename
 
-    suffix = SUFFIX_MAP.get(flavor, WORKBOOK_SUFFIX)
-    return f'twbx/{program}/{program}{suffix}'
+    return program_prefix(program) + program + SUFFIX_MAP.get(flavor, WORKBOOK_SUFFIX)
 
 
 # Given a program or ACM name, return just the program name part, uppercased. ACM-TEST -> TEST, test -> TEST
+@lru_cache(maxsize=256)
 def cannonical_acm_program_name(acmdir: str) -> Union[str, None]:
     if acmdir is None:
         return None
-    _, acm = os.path.split(acmdir)
+    # From the API the name is a bare query string value, like 'LBG-COVID19'; only a path needs splitting.
+    acm = acmdir if '/' not in acmdir and os.sep not in acmdir else os.path.split(acmdir)[1]
     acm = acm.upper()
     if acm.startswith('ACM-'):
         acm = acm[4:]
     return acm
 
 
-def get_s3_params_and_obj_info(program: str, file: str) -> (object, object):
-    params = {'Bucket': stats_bucket}
-    key = object_key(program, file)
+class ObjInfo(NamedTuple):
+    metadata: Dict[str, str]
+    version_id: str
+    size: int
+    last_modified: str
+    key: str
+
 
-    params['Key'] = key
-    head = s3.head_object(**params)
-    obj_info = {'Metadata': head.get('Metadata'),
-                'VersionId': head.get('VersionId'),
-                'Size': head.get('ContentLength'),
-                'LastModified': head.get('LastModified').isoformat(),
-                'Key': params.get('Key')}
+def get_s3_params_and_obj_info(program: str, file: str) -> Tuple[Dict[str, str], ObjInfo]:
+    # Costs a HEAD round trip; only for callers that need the obj_info. Links are signed with _presigned_url().
+    key = object_key(program, file)
+    params = {'Bucket': stats_bucket, 'Key': key}
+    head = _get_s3().head_object(**params)
+    obj_info = ObjInfo(head.get('Metadata'), head.get('VersionId'), head.get('ContentLength'),
+                       head.get('LastModified').isoformat(), key)
     return params, obj_info
 
 
@@ -136,58 +208,148 @@ def _delete_objects(bucket=stats_bucket, prefix=None, delete=lambda obj: True):
             to_delete.append(delete_obj)
         if len(to_delete) == 1000:
             print('Deleting objects: ' + str(to_delete))
-            s3.delete_objects(Delete={'Objects': to_delete}, Bucket=bucket)
+            _get_s3().delete_objects(Delete={'Objects': to_delete}, Bucket=bucket)
             num_deleted += len(to_delete)
             to_delete.clear()
 
     if len(to_delete) > 0:
-        s3.delete_objects(Delete={'Objects': to_delete}, Bucket=bucket)
+        _get_s3().delete_objects(Delete={'Objects': to_delete}, Bucket=bucket)
         num_deleted += len(to_delete)
 
     return num_deleted
 
 
-# List the objects with the given prefix.
-def _list_objects(bucket=stats_bucket, prefix=''):
-    paginator = s3.get_paginator("list_objects_v2")
+# List the objects with the given prefix. With a delimiter, objects "below" the next delimiter aren't listed.
+def _list_objects(bucket=stats_bucket, prefix='', delimiter=None):
+    paginator = _get_s3().get_paginator("list_objects_v2")
     kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
     for objects in paginator.paginate(**kwargs):
         for obj in objects.get('Contents', []):
             yield obj
 
 
-def _get_program_info(program: str) -> Union[Dict[str, str], None]:
+def _program_info_key(program: str) -> str:
+    return f'data/{program}/program_info.csv'
+
+
+def _twbx_data_key(program: str) -> str:
+    return f'data/{program}/twbx_info.csv'
+
+
+def _is_precondition_failed(err: Exception) -> bool:
+    """
+    Is this the error S3 returns when a read's IfMatch doesn't match, ie, the object has changed?
+    """
+    return getattr(err, 'response', {}).get('Error', {}).get('Code') in ('PreconditionFailed', '412')
+
+
+def _get_program_info(program: str, etag: str = None) -> Union[Dict[str, str], None]:
     """
     Gets the content of the projects table for the given program.
     :param program: The program of interest.
+    :param etag: If given, the object's expected ETag; if the object has since changed, the read raises S3's
+        PreconditionFailed error.
     :return: A dict with information about the program. Has at least 'description' as entered by the customer.
     """
-    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': f'data/{program}/program_info.csv'}
+    import codecs
+    import csv
+    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': _program_info_key(program)}
+    if etag:
+        params['IfMatch'] = etag
+
+    def lines(body) -> Iterator[str]:
+        # The object's lines, decoded as they arrive. A line (or a UTF-8 sequence) split between chunks is held
+        # until the rest of it arrives.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        remainder = ''
+        for chunk in body.iter_chunks(8192):
+            parts = (remainder + decoder.decode(chunk)).split('\n')
+            remainder = parts.pop()
+            for part in parts:
+                yield part + '\n'
+        remainder += decoder.decode(b'', final=True)
+        if remainder:
+            yield remainder
+
+    # Only the header and the first row are needed; the reader pulls lines only until it has them, so the rest of
+    # the object is never read. (The csv reader, not a newline count, decides where a record ends, which allows
+    # for quoted newlines in the description.)
     try:
-        obj = s3.get_object(**params)
-        data = obj.get('Body').read().decode('utf-8')
-    except Exception:
+        body = _get_s3().get_object(**params).get('Body')
+        try:
+            return next(csv.DictReader(lines(body)))
+        finally:
+            body.close()
+    except Exception as err:
+        if _is_precondition_failed(err):
+            raise
         return None
-    file_like = io.StringIO(data)
-    csvreader = csv.DictReader(file_like)
-    return next(csvreader)
 
 
-def _get_twbx_data(program: str) -> Union[str, None]:
+def _get_twbx_data(program: str, etag: str = None) -> Union[str, None]:
     """
     Gets the data that Tableau will display. Retrieved from S3 bucket dashboard-lb-stats.
     :param program: The program of interest.
+    :param etag: If given, the object's expected ETag; if the object has since changed, the read raises S3's
+        PreconditionFailed error.
     :return: The contents of the .csv file as a string.
     """
-    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': f'data/{program}/twbx_info.csv'}
+    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': _twbx_data_key(program)}
+    if etag:
+        params['IfMatch'] = etag
     try:
-        obj = s3.get_object(**params)
+        obj = _get_s3().get_object(**params)
         data = obj.get('Body').read().decode('utf-8')
-    except Exception:
+    except Exception as err:
+        if _is_precondition_failed(err):
+            raise
         return None
     return data
 
 
+def _get_etag(key: str) -> Union[str, None]:
+    """
+    Gets the ETag of an object in the stats bucket.
+    :param key: The key of the object of interest.
+    :return: The object's ETag, or None if the object doesn't exist.
+    """
+    try:
+        return _get_s3().head_object(Bucket=stats_bucket, Key=key).get('ETag')
+    except Exception:
+        return None
+
+
+def _list_etags(prefix: str, delimiter=None) -> Dict[str, str]:
+    """
+    Gets the ETags of the objects with the given prefix, from one listing, rather than a HEAD of each.
+    :param prefix: Prefix of the objects of interest.
+    :param delimiter: If given, objects "below" the next delimiter aren't listed.
+    :return: A dict of {key: ETag}.
+    """
+    return {obj.get('Key'): obj.get('ETag') for obj in _list_objects(prefix=prefix, delimiter=delimiter)}
+
+
+def _find_template(program: str) -> Union[Tuple[None, None, None], Tuple[str, str, bool]]:
+    """
+    Finds the Tableau workbook template for the given program. If there is a program-specific template, that is
+    used, otherwise a generic (universal) template is used.
+    :param program: The program of interest.
+    :return: The template's key, its ETag, and whether it is the universal template.
+    """
+    key = object_key(program, 'template')
+    etag = _get_etag(key)
+    if etag is not None:
+        return key, etag, False
+    key = 'twbx/template.twbx'
+    etag = _get_etag(key)
+    if etag is not None:
+        return key, etag, True
+    # Oye.
+    return None, None, None
+
+
 def get_template(program: str) -> Union[Tuple[None, None], Tuple[bytes, bool]]:
     """
     Gets the Tableau workbook template for the given program. If there is a program-specific template, that is
@@ -195,23 +357,46 @@ def get_template(program: str) -> Union[Tuple[None, None], Tuple[bytes, bool]]:
     :param program: The program of interest.
     :return: The data, as a bytes object.
     """
-    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': f'twbx/{program}/{program}{TEMPLATE_SUFFIX}'}
-    universal = False
-    try:
-        s3.head_object(**params)
-    except Exception:
-        params['Key'] = 'twbx/template.twbx'
-        try:
-            s3.head_object(**params)
-            universal = True
-        except Exception:
-            # Oye.
-            return None, None
-    obj = s3.get_object(**params)
+    key, _, universal = _find_template(program)
+    if key is None:
+        return None, None
+    obj = _get_s3().get_object(Bucket=stats_bucket, Key=key)
     data = obj.get('Body').read()
     return data, universal
 
 
+def _get_template_data(key: str, etag: str = None) -> bytes:
+    """
+    Gets the data of a template found by _find_template.
+    :param key: The template's key.
+    :param etag: If given, the template's ETag. The read fails if the template has since changed.
+    :return: The data, as a bytes object.
+    """
+    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': key}
+    if etag:
+        params['IfMatch'] = etag
+    obj = _get_s3().get_object(**params)
+    return obj.get('Body').read()
+
+
+def _cache_prefix(program: str) -> str:
+    return f'{program_prefix(program)}cache/'
+
+
+def _cached_workbook_key(program: str, *etags: Union[str, None]) -> Union[str, None]:
+    """
+    Computes the key under which a workbook composed from the given inputs is cached. The key is derived from
+    the ETags of the inputs, so any change to any input yields a different key.
+    :param program: The program whose workbook is cached.
+    :param etags: The ETags of the template, the program info, and the usage data.
+    :return: The key of the cached workbook, or None if any input doesn't exist.
+    """
+    if not all(etags):
+        return None
+    digest = hashlib.sha1(''.join(etags).encode('utf-8')).hexdigest()
+    return f'{_cache_prefix(program)}{digest}{WORKBOOK_SUFFIX}'
+
+
 def _put_workbook(program: str, workbook: bytes, metadata: Dict[str, str]) -> None:
     """
     Writes a Tableau workbook to S3.
@@ -219,10 +404,10 @@ def _put_workbook(program: str, workbook: bytes, metadata: Dict[str, str]) -> No
     :param workbook: The data of the workbook to be written.
     :return: None
     """
-    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': f'twbx/{program}/{program}{WORKBOOK_SUFFIX}',
+    params: Dict[str, str] = {'Bucket': stats_bucket, 'Key': object_key(program, 'workbook'),
                               'Body': workbook,
                               'Metadata': metadata}
-    s3.put_object(**params)
+    _get_s3().put_object(**params)
 
 
 # noinspection PyShadowingNames
@@ -236,12 +421,15 @@ def _make_workbook_from_template(template: bytes, is_universal_template: bool, d
     :param usage_data: The current usage data for the program. This is .csv data in a single string.
     :return: The updated template.
     """
+    import zipfile
     in_file_like = io.BytesIO(template)
     in_zip = zipfile.ZipFile(in_file_like)
 
     # Copy the template as the workbook. Replace template elements with real ones.
     out_buffer = io.BytesIO()
-    with zipfile.ZipFile(out_buffer, "a", compression=zipfile.ZIP_DEFLATED, allowZip64=False) as out_zip:
+    # Level 1 DEFLATE is much faster than the default, and costs little in size for the XML and CSV content.
+    with zipfile.ZipFile(out_buffer, "a", compression=zipfile.ZIP_DEFLATED, compresslevel=1,
+                         allowZip64=True) as out_zip:
         for zfile in in_zip.filelist:
             zfile_path = Path(zfile.filename)
             with in_zip.open(zfile.filename) as zipped_file:
@@ -254,7 +442,9 @@ def _make_workbook_from_template(template: bytes, is_universal_template: bool, d
                     out_data = usage_data  # usage_data.replace('\x0a', '\x0d\x0a')
                 else:
                     out_data = zipped_file.read()
-                out_zip.writestr(zfile.filename, out_data)
+            # Write with the template entry's ZipInfo, to keep its compression type (already-compressed images are
+            # stored, not deflated again), timestamp, and attributes.
+            out_zip.writestr(zfile, out_data, compresslevel=1)
 
     return out_buffer.getvalue()
 
@@ -278,16 +468,72 @@ def do_refresh(params, claims) -> Dict[str, str]:
                 'submitter-comment': params.get('comment', 'No comment provided'),
                 'submission-date': datetime.datetime.now().isoformat()}
 
-    template, is_universal = get_template(program)
-    info = _get_program_info(program)
-    description = info.get('description', 'Talking Book Program')
-    usage_data = _get_twbx_data(program)
-    twbx = _make_workbook_from_template(template, is_universal, description, usage_data)
-    _put_workbook(program, twbx, metadata)
+    # The inputs' ETags come from listings, concurrently: one of the program's data, and one of the program's
+    # twbx objects, which has the program's template, if any, and the cached workbooks. Only if there's no
+    # program template is the universal template looked up, with a HEAD.
+    f_data_etags = _executor.submit(_list_etags, f'data/{program}/', '/')
+    twbx_etags = _list_etags(program_prefix(program))
+    template_key, is_universal = object_key(program, 'template'), False
+    template_etag = twbx_etags.get(template_key)
+    if template_etag is None:
+        template_key, is_universal = 'twbx/template.twbx', True
+        template_etag = _get_etag(template_key)
+        if template_etag is None:
+            return {'status': STATUS_FAILURE, 'output': ['No workbook template found.']}
+    data_etags = f_data_etags.result()
+    info_etag = data_etags.get(_program_info_key(program))
+    usage_data_etag = data_etags.get(_twbx_data_key(program))
+    cache_key = _cached_workbook_key(program, template_etag, info_etag, usage_data_etag)
+
+    if cache_key is not None and cache_key in twbx_etags:
+        # The workbook has already been composed from these exact inputs; publish the cached copy. S3 does the
+        # copy.
+        _get_s3().copy_object(CopySource={'Bucket': stats_bucket, 'Key': cache_key}, Bucket=stats_bucket,
+                              Key=object_key(program, 'workbook'), MetadataDirective='REPLACE', Metadata=metadata)
+    else:
+        def get_inputs(check_etags: bool):
+            # With check_etags, each read fails if its input has changed since it was listed.
+            f_template = _executor.submit(_get_template_data, template_key, template_etag if check_etags else None)
+            f_info = _executor.submit(_get_program_info, program, info_etag if check_etags else None)
+            f_usage_data = _executor.submit(_get_twbx_data, program, usage_data_etag if check_etags else None)
+            return f_template.result(), f_info.result(), f_usage_data.result()
+
+        try:
+            template, info, usage_data = get_inputs(True)
+        except Exception as err:
+            if not _is_precondition_failed(err):
+                raise
+            # An input changed after it was listed. Build the workbook from the current inputs, but don't cache it
+            # under the key of the listed ones.
+            cache_key = None
+            template, info, usage_data = get_inputs(False)
+
+        description = info.get('description', 'Talking Book Program')
+        twbx = _make_workbook_from_template(template, is_universal, description, usage_data)
+        _put_workbook(program, twbx, metadata)
+        # The one extra PUT makes the next refresh with unchanged inputs a copy, rather than a re-composition.
+        if cache_key is not None:
+            _get_s3().put_object(Bucket=stats_bucket, Key=cache_key, Body=twbx)
+
+    # Only the workbook of the current inputs is kept in the cache; any others can never be used again.
+    stale = [{'Key': key} for key in twbx_etags if key.startswith(_cache_prefix(program)) and key != cache_key]
+    for start in range(0, len(stale), 1000):
+        _get_s3().delete_objects(Bucket=stats_bucket, Delete={'Objects': stale[start:start + 1000]})
 
     return {'status': STATUS_OK}
 
 
+def _presigned_url(key: str, expires_in: int = 3600) -> str:
+    """
+    Signs a GET url for an object in the stats bucket. Signing is local; no request is made to S3.
+    :param key: The object's key.
+    :param expires_in: Lifetime of the url, in seconds.
+    :return: The signed url.
+    """
+    return _get_s3().generate_presigned_url('get_object', Params={'Bucket': stats_bucket, 'Key': key},
+                                            ExpiresIn=expires_in)
+
+
 def _getlinks_all(program: str):
     """
     Gets signed links to the workbook and any preview images.
@@ -295,17 +541,17 @@ def _getlinks_all(program: str):
     @return: A dict with {'workbook': url, 'preview': [url, url,...], 'status': 'ok'
     """
     twbx_name = object_key(program, 'workbook').lower()
-    prefix = f'twbx/{program}/'
+    prefix = program_prefix(program)
     one_week = 7 * 24 * 3600
     workbook_url = None
     preview_urls = []
-    for obj in _list_objects(prefix=prefix):
-        params = {'Bucket': stats_bucket, 'Key': obj.get('Key')}
-        fn = params['Key'].lower()
+    for obj in _list_objects(prefix=prefix, delimiter='/'):
+        key = obj.get('Key')
+        fn = key.lower()
         if fn == twbx_name:
-            workbook_url = s3.generate_presigned_url('get_object', Params=params, ExpiresIn=one_week)
-        elif Path(fn).suffix in PREVIEW_EXTENSIONS:
-            preview_urls.append(s3.generate_presigned_url('get_object', Params=params, ExpiresIn=one_week))
+            workbook_url = _presigned_url(key, expires_in=one_week)
+        elif os.path.splitext(fn)[1] in PREVIEW_EXTENSIONS:
+            preview_urls.append(_presigned_url(key, expires_in=one_week))
     return {'workbook': workbook_url, 'preview': preview_urls, 'status': 'ok'}
 
 
@@ -315,22 +561,24 @@ def do_getlinks(params, claims):
     if not program:
         return {'status': STATUS_MISSING_PARAMETER, 'output': ['Must specify program.']}
     program = cannonical_acm_program_name(program)
+    list_all = 'all' in params
+    # One listing of the program's objects tells us which of the workbook and preview exist; the URLs themselves
+    # are signed locally. The delimiter keeps the cached workbooks out of the listing. Signing is only a few HMACs,
+    # so the time to save is the listing's round trip; start it while the roles are looked up. Nothing from it is
+    # returned unless the caller is authorized.
+    f_keys = None if list_all else _executor.submit(
+        lambda: {obj.get('Key') for obj in _list_objects(prefix=program_prefix(program), delimiter='/')})
     if not authorizer.is_authorized(claims, 'get-link', program):
         return {'status': STATUS_ACCESS_DENIED, 'output': ['Access denied']}
 
-    if 'all' in params:
+    if list_all:
         return _getlinks_all(program)
 
-    try:
-        params, _ = get_s3_params_and_obj_info(program, 'workbook')
-        workbook_url = s3.generate_presigned_url('get_object', Params=params, ExpiresIn=3600)
-    except:
-        workbook_url = None
-    try:
-        params, _ = get_s3_params_and_obj_info(program, 'preview')
-        preview_url = s3.generate_presigned_url('get_object', Params=params, ExpiresIn=3600)
-    except:
-        preview_url = None
+    existing_keys = f_keys.result()
+    workbook_key = object_key(program, 'workbook')
+    preview_key = object_key(program, 'preview')
+    workbook_url = _presigned_url(workbook_key) if workbook_key in existing_keys else None
+    preview_url = _presigned_url(preview_key) if preview_key in existing_keys else None
     return {'workbook': workbook_url, 'preview': preview_url, 'status': 'ok'}
 
 
@@ -343,7 +591,7 @@ def do_upload(data, params, claims):  # program, metadata):
     if not authorizer.is_authorized(claims, 'upload-twbx-template', program):
         return {'status': STATUS_ACCESS_DENIED, 'output': ['Access denied']}
     filename = params.get('filename')
-    ext = Path(filename).suffix.lower()
+    ext = os.path.splitext(filename)[1].lower() if filename else ''
 
     if ext in PREVIEW_EXTENSIONS:
         key = object_key(program, flavor='preview', filename=filename)
@@ -358,8 +606,8 @@ def do_upload(data, params, claims):  # program, metadata):
                 'submitter-comment': params.get('comment', 'No comment provided'),
                 'submission-date': datetime.datetime.now().isoformat()}
 
-    put_result = s3.put_object(Body=data, Bucket=stats_bucket, Metadata=metadata, Key=key)
-    print('Put {} with result {}'.format(key, put_result))
+    put_result = _get_s3().put_object(Body=data, Bucket=stats_bucket, Metadata=metadata, Key=key)
+    logger.debug('Put %s with result %s', key, put_result)
     result = {'status': STATUS_OK, 'ETag': put_result.get('ETag')}
 
     return result
@@ -373,7 +621,7 @@ def do_remove_previews(params, claims):
     if not authorizer.is_authorized(claims, 'remove-preview', program):
         return {'status': STATUS_ACCESS_DENIED, 'output': ['Access denied']}
 
-    prefix = f'twbx/{program}/'
+    prefix = program_prefix(program)
     num_deleted = _delete_objects(prefix=prefix, delete=lambda obj: not obj.get('Key').lower().endswith('.twbx'))
 
     result = {'status': STATUS_OK, 'numDeleted': num_deleted}
@@ -383,40 +631,34 @@ def do_remove_previews(params, claims):
 # noinspection PyUnusedLocal
 def lambda_handler(event, context):
     global authorizer
-    start = time.time_ns()
-
-    keys = [x for x in event.keys()]
-    # info = {'keys': keys}
-    #         'resource': event.get('resource', '-no resource'),
-    #         'path': event.get('path', '-no path'),
-    #         'httpMethod': event.get("httpMethod", '-no httpMethod')}
-    # for key in keys:
-    #     if key != 'body':
-    #         info[key] = event.get(key, '-no ' + key)
+    debug = bool(os.environ.get('TWBX_DEBUG'))
+    start = time.perf_counter_ns() if debug else 0
+
     parts = [x for x in event.get('pathParameters', {}).get('proxy', 'validate').split('/') if x != 'data']
     action = parts[0]
 
     path = event.get('path', {})
     path_parameters = event.get('pathParameters', {})
-    multi_value_query_string_parameters = event.get('multiValueQueryStringParameters', {})
     query_string_params = event.get('queryStringParameters', {})
 
-    print('pathParameters: {}, path: {}, action: {}'.format(path_parameters, path, action))
-    print('queryStringParameters: {}'.format(query_string_params))
+    logger.debug('pathParameters: %s, path: %s, action: %s', path_parameters, path, action)
+    logger.debug('queryStringParameters: %s', query_string_params)
     result = {'output': [],
               'status': ''}
 
+    # Only an upload has a body, so only an upload decodes it. It arrives base64 encoded. The caller's event is left
+    # as it is.
     data = None
-    body = event.get('body')
-    if body is None:
-        print('Body is None')
-    else:
-        print('Body is {} characters long'.format(len(body)))
-    if body:
-        try:
-            data = binascii.a2b_base64(body)
-        except (binascii.Error, binascii.Incomplete):
-            data = None
+    if action == 'upload':
+        body = event.get('body')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Body is None' if body is None else f'Body is {len(body)} characters long')
+        if body:
+            try:
+                data = base64.b64decode(body)
+            except (ValueError, TypeError):
+                data = None
+        del body
 
     claims = event.get('requestContext', {}).get('authorizer', {}).get('claims', {})
 
@@ -437,24 +679,29 @@ def lambda_handler(event, context):
             result = {'status': 'ok'}
 
     except Exception as ex:
+        import traceback
         traceback.print_exception(type(ex), ex, ex.__traceback__)
         result['status'] = STATUS_FAILURE
         result['exception'] = 'Exception: {}'.format(ex)
 
-    end = time.time_ns()
+    response_body = {'msg': 'Program Specification Utility',
+                     'result': result}
+    # The timing, and echoing the request back, are only useful while debugging; set TWBX_DEBUG in the function's
+    # environment.
+    if debug:
+        response_body.update({'msec': (time.perf_counter_ns() - start) / 1000000,
+                              'keys': list(event.keys()),
+                              'claims': claims,
+                              'action': action,
+                              'path': path,
+                              'path_parameters': path_parameters,
+                              'query_string_params': query_string_params,
+                              'multi_value_query_string_parameters': event.get('multiValueQueryStringParameters',
+                                                                               {})})
     return {
         'statusCode': 200,
         "headers": {"Access-Control-Allow-Origin": "*"},
-        'body': json.dumps({'msg': 'Program Specification Utility',
-                            # 'keys': keys,
-                            'result': result,
-                            # 'claims': claims,
-                            # 'action': action,
-                            # 'path': path,
-                            # 'path_parameters': path_parameters,
-                            # 'query_string_params': query_string_params,
-                            # 'multi_value_query_string_parameters': multi_value_query_string_parameters,
-                            'msec': (end - start) / 1000000})
+        'body': _dumps(response_body)
     }
 
 
@@ -470,7 +717,7 @@ if __name__ == '__main__':
         def test_upload(fn, file, comment='No commment provided.'):
             print('\nupload {}:'.format(fn))
             bytes_read = open(expanduser(fn), "rb").read()
-            body_data = binascii.b2a_base64(bytes_read)
+            body_data = base64.b64encode(bytes_read)
 
             upload_event = {'requestContext': {'authorizer': {'claims': claims}},
                             'pathParameters': {'proxy': 'upload'}, 'queryStringParameters': {'program': _PROGRAM,
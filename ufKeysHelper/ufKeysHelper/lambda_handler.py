@@ -1,10 +1,8 @@
 import base64
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import boto3 as boto3
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
-from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from botocore.exceptions import ClientError
 
 from amplio.utils import LambdaRouter, handler, QueryStringParam
 
@@ -15,6 +13,11 @@ dynamodb = session.resource('dynamodb', region_name=REGION_NAME)
 KEY_TABLE_NAME = 'uf_keys'
 uf_key_table = None
 
+# A key pair never changes once saved, so warm containers keep the ones they've seen. Only pairs that exist are
+# cached; a miss must always go back to the table.
+_key_pair_cache: Dict[Tuple[str, int], Tuple[bytes, bytes]] = {}
+_public_b64_cache: Dict[Tuple[str, int], str] = {}
+
 
 def get_uf_keys(programid: str, deployment_num: int) -> Optional[Tuple[bytes, bytes]]:
     """
@@ -23,6 +26,9 @@ def get_uf_keys(programid: str, deployment_num: int) -> Optional[Tuple[bytes, by
     :param deployment_num: The deployment within the program to which the keys apply.
     :return: a Tuple of (private_pem,public_der) if the keys exist, or None if they do not.
     """
+    pair = _key_pair_cache.get((programid, deployment_num))
+    if pair is not None:
+        return pair
     global uf_key_table
     if uf_key_table is None:
         uf_key_table = dynamodb.Table(KEY_TABLE_NAME)
@@ -30,7 +36,12 @@ def get_uf_keys(programid: str, deployment_num: int) -> Optional[Tuple[bytes, by
     key_row = query.get('Item')
     if key_row:
         print(f'Retrieved key pair for {programid} deployment # {deployment_num}')
-        return (key_row.get('private_pem'), key_row.get('public_der'))
+        pair = (key_row.get('private_pem'), key_row.get('public_der'))
+        _key_pair_cache[(programid, deployment_num)] = pair
+        # Rows saved before public_b64 was added don't have it; publickey encodes public_der for those.
+        if key_row.get('public_b64'):
+            _public_b64_cache[(programid, deployment_num)] = key_row.get('public_b64')
+        return pair
 
 
 def save_uf_keys(programid: str, deployment_num: int, private_pem: bytes, public_der: bytes) -> bool:
@@ -45,29 +56,30 @@ def save_uf_keys(programid: str, deployment_num: int, private_pem: bytes, public
     global uf_key_table
     if uf_key_table is None:
         uf_key_table = dynamodb.Table(KEY_TABLE_NAME)
-    query = uf_key_table.get_item(Key={'programid': programid, 'deployment_num': deployment_num})
-    key_row = query.get('Item')
-    if key_row:
-        print(f'Key pair already exists for {programid}, depl # {deployment_num}')
-        return False
 
     print(f'Creating uf_key record for {programid} deployment # {deployment_num}')
-    update_expr = 'SET private_pem = :p, public_der = :d'
-    expr_values = {
-        ':p': private_pem,
-        ':d': public_der
-    }
-
+    # The condition makes the existence check and the write one request, and a key pair, once saved, can never
+    # be replaced by a concurrent request.
+    # The public key is also saved in the base64 form that publickey returns, so it needn't be encoded per request.
+    public_b64 = base64.b64encode(bytes(public_der)).decode('ascii')
     try:
-        uf_key_table.update_item(
-            Key={'programid': programid, 'deployment_num': deployment_num},
-            UpdateExpression=update_expr,
-            ExpressionAttributeValues=expr_values
+        uf_key_table.put_item(
+            Item={'programid': programid, 'deployment_num': deployment_num,
+                  'private_pem': private_pem, 'public_der': public_der, 'public_b64': public_b64},
+            ConditionExpression='attribute_not_exists(programid)'
         )
+    except ClientError as err:
+        if err.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            print(f'Key pair already exists for {programid}, depl # {deployment_num}')
+        else:
+            print(f'Exception creating uf_key record for {programid} deployment # {deployment_num}: {err}')
+        return False
     except Exception as err:
         print(f'Exception creating uf_key record for {programid} deployment # {deployment_num}: {err}')
         return False
 
+    _key_pair_cache[(programid, deployment_num)] = (private_pem, public_der)
+    _public_b64_cache[(programid, deployment_num)] = public_b64
     return True
 
 
@@ -79,6 +91,12 @@ def generate_key_pair():
     This 2048 bit PK is what the TBv2 expects/needs.
     :return: a Tuple of the (private_pem,public_der).
     """
+    # Imported here because loading the OpenSSL bindings is a noticeable part of a cold start, and most requests
+    # find an existing key pair and never get here.
+    from cryptography.hazmat.backends import default_backend as crypto_default_backend
+    from cryptography.hazmat.primitives import serialization as crypto_serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
     key = rsa.generate_private_key(
         backend=crypto_default_backend(),
         public_exponent=65537,
@@ -108,6 +126,10 @@ def publickey(programid: QueryStringParam[str], deployment_num: QueryStringParam
     :param deployment_num: The deployment within the program to which the keys apply.
     :return public_der: The public key as bytes.
     """
+    public_b64 = _public_b64_cache.get((programid, deployment_num))
+    if public_b64 is not None:
+        return {"public_key": public_b64}
+
     # Has this key pair already been created?
     pair: Optional[Tuple[bytes, bytes]] = get_uf_keys(programid, deployment_num)
     if pair is not None:
@@ -115,8 +137,18 @@ def publickey(programid: QueryStringParam[str], deployment_num: QueryStringParam
     else:
         # No, create and save the key pair.
         private_pem, public_der = generate_key_pair()
-        save_uf_keys(programid, deployment_num, private_pem, public_der)
-    return {"public_key": base64.b64encode(bytes(public_der)).decode('ascii')}
+        if not save_uf_keys(programid, deployment_num, private_pem, public_der):
+            # Another request may have saved a pair first; if so, that's the one the Talking Books must use.
+            pair = get_uf_keys(programid, deployment_num)
+            if pair is not None:
+                public_der = pair[1]
+    public_b64 = _public_b64_cache.get((programid, deployment_num))
+    if public_b64 is not None:
+        return {"public_key": public_b64}
+    public_b64 = base64.b64encode(bytes(public_der)).decode('ascii')
+    if (programid, deployment_num) in _key_pair_cache:
+        _public_b64_cache[(programid, deployment_num)] = public_b64
+    return {"public_key": public_b64}
 
 
 def lambda_router(event, context):
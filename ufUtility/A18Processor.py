@@ -1,6 +1,8 @@
 import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Union, Any, Tuple, Dict
+from typing import List, Union, Any, Tuple, Dict, Deque, Optional
 
 from UfMetadata import UfMetadata
 from a18file import A18File, MD_MESSAGE_UUID_TAG
@@ -16,6 +18,29 @@ class A18Processor(FilesProcessor):
         return p.suffix.lower() == '.a18'
 
     def extract_uf_files(self, out_dir:Path, **kwargs) -> Tuple[int, int, int, int, int]:
+        def _export(a18_file: A18File, a18_path: Path, fb_path: Path, md_path: Path) -> \
+                Tuple[Path, Optional[Dict[str, str]]]:
+            # Converts the audio directly to the target location.
+            audio_path: Union[Path, Any] = a18_file.export_audio(audio_format, output=fb_path)
+            # Save the size of the file, to be used when assembling bundles of uf files. One stat
+            # answers both whether the file exists and how big it is.
+            try:
+                audio_size = audio_path.stat().st_size if audio_path else None
+            except FileNotFoundError:
+                audio_size = None
+            if audio_size is None:
+                return a18_path, None
+            # Save a copy of the metadata, augmented with the audio file size.
+            return a18_path, a18_file.save_sidecar(save_as=md_path, extra_data={'metadata.BYTES': str(audio_size)})
+
+        def _collect(future: Future) -> None:
+            # The metadata is accumulated here, on the calling thread, rather than by the exports.
+            a18_path, metadata = future.result()
+            if metadata is not None and not no_db:
+                if verbose > 1:
+                    print(f'Adding metadata properties for {str(a18_path)}.')
+                propertiesProcessor.add_from_dict(metadata)
+
         def _a18_processor(a18_path: Path) -> Union[None,bool]:
             if verbose > 0:
                 print(f'Processing file \'{str(a18_path)}\'.')
@@ -27,47 +52,57 @@ class A18Processor(FilesProcessor):
                 if not (programid and deploymentnumber):
                     print(f'Missing value for "PROJECT" or "DEPLOYMENT_NUMBER" in .properties for {a18_path.name}')
                     return False
-                fb_dir = Path(out_dir, programid, deploymentnumber)
-                fb_path = Path(fb_dir, message_uuid).with_suffix(audio_format)
-                md_path = fb_path.with_suffix('.properties')
+                # Many files share a program and deployment; build (and create) each directory only once.
+                fb_dir = dir_cache.get((programid, deploymentnumber))
+                if fb_dir is None:
+                    fb_dir = Path(out_dir, programid, deploymentnumber)
+                    if not dry_run:
+                        fb_dir.mkdir(parents=True, exist_ok=True)
+                    dir_cache[(programid, deploymentnumber)] = fb_dir
+                fb_path = fb_dir / f'{message_uuid}{audio_suffix}'
+                md_path = fb_dir / f'{message_uuid}.properties'
                 if dry_run:
                     print(f'Dry run, not exporting \'{str(fb_path)}\'.')
                     print(f'Dry run, not saving metadata \'{str(md_path)}\'.')
                 else:
-                    # Converts the audio directly to the target location.
-                    audio_path: Union[Path, Any] = a18_file.export_audio(audio_format, output=fb_path)
-                    # Save the size of the file, to be used when assembling bundles of uf files.
-                    if audio_path and audio_path.exists():
-                        # Save a copy of the metadata, augmented with the audio file size.
-                        metadata = a18_file.save_sidecar(save_as=md_path, extra_data={
-                            'metadata.BYTES': str(os.path.getsize(audio_path))})
-                        if not no_db:
-                            if verbose > 1:
-                                print(f'Adding metadata properties for {str(a18_path)}.')
-                            propertiesProcessor.add_from_dict(metadata)
+                    # The conversion runs in its own process; run several at once. Only a few exports are kept
+                    # waiting, so that a large tree isn't all queued before any results are collected.
+                    pending.append(executor.submit(_export, a18_file, a18_path, fb_path, md_path))
+                    if len(pending) >= 2 * workers:
+                        _collect(pending.popleft())
             else:
                 print(f'Couldn\'t update sidecar for \'{str(a18_path)}\'.')
         propertiesProcessor = UfMetadata()
         no_db = kwargs.get('no_db', False)
         audio_format = kwargs.get('format')
+        audio_suffix = audio_format if audio_format.startswith('.') else '.' + audio_format
         verbose = kwargs.get('verbose', 0)
         dry_run = kwargs.get('dry_run', False)
+        dir_cache: Dict[Tuple[str, str], Path] = {}
+        workers = kwargs.get('workers') or os.cpu_count() or 1
+        pending: Deque[Future] = deque()
         kw: Dict[str, str] = {k: v for k, v in kwargs.items() if k in ['limit', 'verbose', 'files']}
 
-        return self.process_files(A18Processor._a18_acceptor, _a18_processor, **kw)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            result = self.process_files(A18Processor._a18_acceptor, _a18_processor, suffix='.a18', **kw)
+            while pending:
+                _collect(pending.popleft())
+        return result
 
     def convert_a18_files(self, **kwargs) -> Tuple[int, int, int, int, int]:
         def _a18_processor(a18_path: Path) -> None:
             if verbose > 0:
                 print(f'Processing file \'{str(a18_path)}\'.')
             a18_file = A18File(a18_path, verbose=verbose, dry_run=dry_run)
-            # TODO: Why do we need to update the sidecar to export the audio in a new format?
-            if a18_file.update_sidecar():
+            # Converting needs only the audio, but keeps the sidecar up to date while at it. An already
+            # current sidecar is left alone, which skips reading the metadata and the database queries.
+            if a18_file.sidecar_is_current() or a18_file.update_sidecar():
                 a18_file.export_audio(audio_format)
 
         audio_format = kwargs.get('format')
         verbose = kwargs.get('verbose', 0)
         dry_run = kwargs.get('dry_run', False)
-        kw: Dict[str, str] = {k: v for k, v in kwargs.items() if k in ['limit', 'verbose', 'files']}
+        # Each conversion is independent of the others; with 'workers', several run at once.
+        kw: Dict[str, str] = {k: v for k, v in kwargs.items() if k in ['limit', 'verbose', 'files', 'workers']}
 
-        return self.process_files(A18Processor._a18_acceptor, _a18_processor, **kw)
+        return self.process_files(A18Processor._a18_acceptor, _a18_processor, suffix='.a18', **kw)
@@ -3,19 +3,77 @@ UfBundler - a class to "bundle" user feedback messages into bite-sized .zip file
 
 
 """
-import io
+import os
+import shutil
+import tempfile
+import threading
+import time
 import uuid
 import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from dataclasses import field, dataclass
 from io import StringIO
-from typing import List, Dict
+from typing import BinaryIO, List, Dict, Tuple
 
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 
 from UfRecord import UfRecord
 from dbutils import DbUtils
 
-s3 = boto3.client('s3')
+# The client is shared by the threads that fetch UF files; it has enough connections (S3_MAX_POOL_CONNECTIONS) that
+# they don't queue for one.
+# It's created on first use, so importing this module (eg, for the commands that don't bundle) doesn't pay for it.
+_s3 = None
+_s3_lock = threading.Lock()
+_transfer_manager = None
+# How many UF files to fetch at once while zipping a bundle, and how many bundles to zip at once.
+FETCH_WORKERS = 32
+BUNDLE_WORKERS = 8
+# Fetched files, and the zips being built, are kept in memory up to these sizes, and beyond that spill to disk.
+SPOOL_FILE_SIZE = 8 << 20
+SPOOL_ZIP_SIZE = 64 << 20
+COPY_CHUNK_SIZE = 1 << 20
+# Files at least this big are fetched by the transfer manager, as several concurrent byte ranges; one connection is
+# limited in throughput.
+RANGED_GET_THRESHOLD = 16 << 20
+DOWNLOAD_CONFIG = TransferConfig(multipart_threshold=RANGED_GET_THRESHOLD, multipart_chunksize=8 << 20,
+                                 max_concurrency=32)
+# How many S3 copies to have in flight when publishing unzipped files.
+COPY_WORKERS = 100
+# Zips over the threshold are uploaded as a multipart upload, several parts at a time.
+UPLOAD_CONFIG = TransferConfig(multipart_threshold=8 << 20, max_concurrency=8)
+# Every fetch thread of every bundle being zipped may hold a connection, as may the transfer manager's threads.
+S3_MAX_POOL_CONNECTIONS = BUNDLE_WORKERS * FETCH_WORKERS + DOWNLOAD_CONFIG.max_concurrency
+
+
+def _get_s3():
+    global _s3
+    if _s3 is None:
+        with _s3_lock:
+            if _s3 is None:
+                # Pinning the region saves resolving it; adaptive retries absorb throttling from the many
+                # concurrent requests.
+                _s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION', 'us-west-2'),
+                                   config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                                 retries={'max_attempts': 5, 'mode': 'adaptive'}))
+    return _s3
+
+
+def _get_transfer_manager():
+    """
+    The one s3transfer TransferManager, shared by all bundles, so that its threads and connections are reused. It
+    finds the object's real size and fetches the byte ranges itself, so it doesn't depend on the length_bytes
+    recorded in the database (which, for some older messages, is only an estimate).
+    """
+    global _transfer_manager
+    if _transfer_manager is None:
+        s3 = _get_s3()
+        with _s3_lock:
+            if _transfer_manager is None:
+                _transfer_manager = create_transfer_manager(s3, DOWNLOAD_CONFIG)
+    return _transfer_manager
 
 
 def t(s):
@@ -58,17 +116,19 @@ class UfBundler():
         self._out_bucket = bucket
         self._dry_run = kwargs.get('dry_run', False)
         self._verbose = kwargs.get('verbose', 0)
-        self._limit= kwargs.get('limit', 2^31) # an arbitrary large number
+        self._limit= kwargs.get('limit', 2**31) # an arbitrary large number
 
-        self._db = DbUtils(args=None)
+        # DbUtils is a singleton; every bundler shares its connection.
+        self._db = DbUtils()
 
-    def _make_zipped_bundle(self, bundle: BundleInfo) -> bytes:
+    def _make_zipped_bundle(self, bundle: BundleInfo) -> BinaryIO:
         """
         Given the bundle info for a bundle of UF files, create a .zip archive of all of those UF files. Return
-        the bytes of the .zip archive; the caller can write to a file, to an S3 bucket, or whatever they wish.
+        a file holding the .zip archive, positioned at the start; the caller can copy it to a file, to an S3
+        bucket, or whatever they wish, and must close it.
         Zipping is only for packaging; the files are typically essentially uncompressable audio (ie, .mp3 files).
         :param bundle: The list of UF files.
-        :return: The bytes of a .zip archive of the files.
+        :return: A file of the .zip archive of the files.
         """
         if self._verbose > 0:
             print(
@@ -76,16 +136,60 @@ class UfBundler():
         # get the output bucket and prefix
         input_bucket = 'amplio-uf'
         input_prefix = f'collected/{self._programid}/{self._deployment_number}/'
-        out_buffer = io.BytesIO()
-        with zipfile.ZipFile(out_buffer, "w", compression=zipfile.ZIP_STORED, allowZip64=False) as out_zip:
-            for uf in bundle.uf_list:
-                filename = uf.message_uuid + '.mp3'
-                input_key = input_prefix + filename
-                input_obj = s3.get_object(Bucket=input_bucket, Key=input_key)
-                input_data = input_obj.get('Body').read()
-                out_zip.writestr(filename, input_data)
-            out_zip.close()
-        return out_buffer.getvalue()
+        # (name in the zip, key in the input bucket, size) of every file, built before any fetching starts.
+        work: List[Tuple[str, str, int]] = []
+        for uf in bundle.uf_list:
+            filename = uf.message_uuid + '.mp3'
+            work.append((filename, input_prefix + filename, uf.length_bytes))
+
+        def fetch(item: Tuple[str, str, int]) -> BinaryIO:
+            _, input_key, size = item
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_FILE_SIZE)
+            if size and size >= RANGED_GET_THRESHOLD:
+                _get_transfer_manager().download(input_bucket, input_key, spool).result()
+            else:
+                body = _get_s3().get_object(Bucket=input_bucket, Key=input_key).get('Body')
+                for chunk in body.iter_chunks(COPY_CHUNK_SIZE):
+                    spool.write(chunk)
+            spool.seek(0)
+            return spool
+
+        # Neither the files nor the zip are ever held in memory as a single bytes object; both are streamed in
+        # chunks, and spill to disk when large.
+        out_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_ZIP_SIZE)
+        date_time = time.localtime()[:6]
+        # The files are fetched in parallel, and each is written to the zip as soon as it arrives; the order of the
+        # files within the zip doesn't matter. At most FETCH_WORKERS files are fetched, or fetched and waiting to be
+        # written, at once, so a big bundle doesn't have all of its files spooled at the same time. The entries are
+        # stored, not compressed; the only per-byte work is the CRC-32, which zipfile computes with zlib's C
+        # implementation. It can't be skipped, as unzip tools reject entries whose CRC doesn't match.
+        # Zip64 is allowed, so a bundle that grows past 4GB is still written, rather than failing after all its
+        # bytes have been fetched. Giving each entry its size up front lets zipfile decide whether that entry needs
+        # the Zip64 extension before writing its header.
+        with zipfile.ZipFile(out_file, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as out_zip, \
+                ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            def add_to_zip(future: Future) -> None:
+                with future.result() as input_file:
+                    zip_info = zipfile.ZipInfo(futures.pop(future), date_time=date_time)
+                    zip_info.file_size = input_file.seek(0, 2)
+                    input_file.seek(0)
+                    with out_zip.open(zip_info, 'w') as zip_entry:
+                        shutil.copyfileobj(input_file, zip_entry, COPY_CHUNK_SIZE)
+
+            # { fetch in progress (or done, not yet written) : name in the zip }
+            futures: Dict[Future, str] = {}
+            for item in work:
+                if len(futures) >= FETCH_WORKERS:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        add_to_zip(future)
+                futures[executor.submit(fetch, item)] = item[0]
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    add_to_zip(future)
+        out_file.seek(0)
+        return out_file
 
     def _make_zipped_bundles(self, bundles: List[BundleInfo]) -> str:
         """
@@ -95,71 +199,100 @@ class UfBundler():
         :param bundles: The UF bundles to be zipped.
         :return: the operation-uuid.
         """
-        all_ok = True
         # get the output bucket and prefix
         bucket = self._out_bucket or 'downloads.amplio.org'
         root = str(uuid.uuid4())
-        for bundle in bundles:
-            key = f'{root}/deployment-{self._deployment_number}/{bundle.language}/{bundle.bundle_uuid}.zip'
-            if self._dry_run:
-                print(
-                    f'dry_run, not zipping {bundle.bytes} bytes in {len(bundle.uf_list)} files  for {bundle.language} in {bundle.bundle_uuid}.')
-            else:
-                bundle_data = self._make_zipped_bundle(bundle)
-                put_result = s3.put_object(Bucket=bucket, Key=key, Body=bundle_data)
+        # Each bundle is fetched, zipped, and uploaded independently of the others, so several are done at once.
+        with ThreadPoolExecutor(max_workers=BUNDLE_WORKERS) as executor:
+            futures = [executor.submit(self._zip_and_put, bundle, bucket, root) for bundle in bundles]
+            all_ok = all([f.result() for f in futures])
+        if not all_ok:
+            print(f'Not all bundles were uploaded to {bucket}/{root}.')
         return root
 
+    def _zip_and_put(self, bundle: BundleInfo, bucket: str, root: str) -> bool:
+        """
+        Zip one bundle and upload the zip to s3://{bucket}/{root}/deployment-{n}/{language}/{bundle-uuid}.zip
+        :param bundle: The UF bundle to be zipped.
+        :param bucket: The bucket to which to upload the zip.
+        :param root: The operation-uuid under which to upload the zip.
+        :return: True if the zip was uploaded (or this is a dry run), False if it failed.
+        """
+        key = f'{root}/deployment-{self._deployment_number}/{bundle.language}/{bundle.bundle_uuid}.zip'
+        if self._dry_run:
+            print(
+                f'dry_run, not zipping {bundle.bytes} bytes in {len(bundle.uf_list)} files  for {bundle.language} in {bundle.bundle_uuid}.')
+            return True
+        # upload_fileobj reads the zip in parts, and uploads large ones as a multipart upload.
+        try:
+            with self._make_zipped_bundle(bundle) as bundle_file:
+                _get_s3().upload_fileobj(bundle_file, bucket, key, Config=UPLOAD_CONFIG)
+        except Exception as ex:
+            # Let the other bundles carry on; the failure is reported with the rest.
+            print(f'Exception zipping or uploading {bundle.bundle_uuid} for {bundle.language}: {ex}')
+            return False
+        return True
+
     def _publish_unzipped(self, bundles: List[BundleInfo]) -> str:
-        num_copied = 0
         in_bucket = 'amplio-uf'
         out_bucket = self._out_bucket or 'downloads.amplio.org'
         root = str(uuid.uuid4())
+        # Decide everything that will be copied, up to the limit, then let S3 do the copies concurrently.
+        work = []
         for bundle in bundles:
             for uf in bundle.uf_list:
                 in_key = f'collected/{self._programid}/{self._deployment_number}/{uf.message_uuid}.mp3'
                 out_key = f'{root}/deployment-{self._deployment_number}/{bundle.language}/{uf.message_uuid}.mp3'
-                if self._dry_run:
-                    print(f'dry_run, not copying {uf.length_bytes} bytes from {in_key} to {out_key}.')
-                else:
-                    copy_result = s3.copy_object(Bucket=out_bucket, Key=out_key, CopySource={'Bucket':in_bucket, 'Key':in_key})
-                num_copied += 1
-                if num_copied >= self._limit:
+                work.append((in_key, out_key, uf.length_bytes))
+                if len(work) >= self._limit:
                     break
-            if num_copied >= self._limit:
+            if len(work) >= self._limit:
                 break
-        return root
-
 
-    def _get_uf_records(self, rebundle=False) -> List[UfRecord]:
-        import datetime
+        if self._dry_run:
+            for in_key, out_key, length_bytes in work:
+                print(f'dry_run, not copying {length_bytes} bytes from {in_key} to {out_key}.')
+        else:
+            def copy(item) -> None:
+                in_key, out_key, _ = item
+                _get_s3().copy_object(Bucket=out_bucket, Key=out_key, CopySource={'Bucket': in_bucket, 'Key': in_key})
 
-        def keep(x: UfRecord) -> bool:
-            return (x.bundle_uuid is None or x.bundle_uuid == '' or rebundle) \
-                   and x.length_seconds >= self._min_uf_duration and x.length_seconds <= self._max_uf_duration
+            with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+                list(executor.map(copy, work))
+        return root
 
-        rows: List[UfRecord] = self._db.get_uf_records(programid=self._programid,
-                                                       deploymentnumber=self._deployment_number)
 
-        good_uf: List[UfRecord] = [x for x in rows if keep(x)]
-        print(f'Received {len(rows)} rows, {len(good_uf)} meet length criteria.')
+    def _get_uf_records(self, rebundle=False) -> List[UfRecord]:
+        # The database applies the length and bundled criteria, so only the messages to be bundled are returned.
+        good_uf: List[UfRecord] = self._db.get_uf_records(programid=self._programid,
+                                                          deploymentnumber=self._deployment_number,
+                                                          min_seconds=self._min_uf_duration,
+                                                          max_seconds=self._max_uf_duration,
+                                                          only_unbundled=not rebundle)
+        print(f'Received {len(good_uf)} rows meeting length criteria.')
         return good_uf
 
     def _get_partitioned_records(self, bundle_uuids=None) -> List[BundleInfo]:
         rows: List[UfRecord] = self._db.get_uf_records(programid=self._programid,
                                                        deploymentnumber=self._deployment_number)
 
-        # previously bundled messages, limited to a set of existing uuids, if desired
-        good_uf: List[UfRecord] = [x for x in rows if x.bundle_uuid is not None and (
-                bundle_uuids is None or x.bundle_uuid in bundle_uuids)]
-
-        print(f'Received {len(rows)} rows, {len(good_uf)} already bundled.')
-        # put uf records into their respective bundles
+        if bundle_uuids is not None:
+            bundle_uuids = frozenset(bundle_uuids)
+        # put previously bundled messages into their respective bundles, limited to a set of existing uuids, if desired
+        n_bundled = 0
         bundles: Dict[str, BundleInfo] = {}
-        for uf in good_uf:
-            bundle = bundles.setdefault(uf.bundle_uuid, BundleInfo(language=uf.language, bundle_uuid=uf.bundle_uuid))
+        for uf in rows:
+            if uf.bundle_uuid is None or (bundle_uuids is not None and uf.bundle_uuid not in bundle_uuids):
+                continue
+            n_bundled += 1
+            bundle = bundles.get(uf.bundle_uuid)
+            if bundle is None:
+                bundle = bundles[uf.bundle_uuid] = BundleInfo(language=uf.language, bundle_uuid=uf.bundle_uuid)
             bundle.uf_list.append(uf)
             bundle.bytes += uf.length_bytes
             bundle.seconds += uf.length_seconds
+
+        print(f'Received {len(rows)} rows, {n_bundled} already bundled.')
         return list(bundles.values())
 
     def _partition(self, good_uf: List[UfRecord]) -> List[BundleInfo]:
@@ -171,25 +304,37 @@ class UfBundler():
         :param good_uf: A list of the UF files to bundle.
         :return: A list of bundles of UF files.
         """
+        # First-Fit-Decreasing, per language: place the largest messages first, each into the first bundle with
+        # room for it. That leaves far fewer part-empty bundles than filling them in arrival order.
+        by_language: Dict[str, List[UfRecord]] = {}
+        for uf in good_uf:
+            by_language.setdefault(uf.language, []).append(uf)
+
+        # The packing works on plain lists of ints, parallel to the sorted messages, rather than reading attributes
+        # of the records and bundles in the inner loop; the BundleInfo objects are built once it's done.
+        max_bytes = self._max_bytes
         partitions: List[BundleInfo] = []
-        current_partitions: Dict[str, BundleInfo] = {}
-        for ix in range(0, len(good_uf)):
-            uf = good_uf[ix]
-            language = uf.language
-            current_partition = current_partitions.setdefault(language, BundleInfo(language=language))
-            # Does this message fit?
-            if current_partition.bytes + uf.length_bytes > self._max_bytes and len(current_partition.uf_list) > 0:
-                # Didn't fit, save previous partition, create a new, empty one for this language
-                partitions.append(current_partition)
-                current_partition = BundleInfo(language=language)
-                current_partitions[language] = current_partition
-            # Add message to current partition.
-            current_partition.uf_list.append(uf)
-            current_partition.bytes += uf.length_bytes
-            current_partition.seconds += uf.length_seconds
-        # Capture the partitions that were "in progress"
-        for p in current_partitions.values():
-            partitions.append(p)
+        for language, ufs in by_language.items():
+            ufs.sort(key=lambda x: x.length_bytes, reverse=True)
+            sizes: List[int] = [uf.length_bytes for uf in ufs]
+            bin_bytes: List[int] = []
+            bin_members: List[List[int]] = []
+            for ix, size in enumerate(sizes):
+                # Does this message fit in an existing partition? (A message larger than the maximum gets a
+                # partition to itself.)
+                for bin_ix, used in enumerate(bin_bytes):
+                    if used + size <= max_bytes:
+                        break
+                else:
+                    bin_ix = len(bin_bytes)
+                    bin_bytes.append(0)
+                    bin_members.append([])
+                bin_bytes[bin_ix] += size
+                bin_members[bin_ix].append(ix)
+            for used, members in zip(bin_bytes, bin_members):
+                uf_list = [ufs[ix] for ix in members]
+                partitions.append(BundleInfo(language=language, uf_list=uf_list, bytes=used,
+                                             seconds=sum(uf.length_seconds for uf in uf_list)))
 
         if self._verbose > 1:
             for p in partitions:
@@ -203,19 +348,21 @@ class UfBundler():
         :param bundles: to be updated.
         :return: True if the update was successful, False otherwise.
         """
-        # allocate a bundle id for the partitions
-        for b in bundles:
-            b.bundle_uuid = uuid.uuid4()
+        # allocate a bundle id for the partitions. One read of random bytes for all of them, and each id formatted as
+        # a str once, since it's used as a key and in file names.
+        raw = os.urandom(16 * len(bundles))
+        for ix, b in enumerate(bundles):
+            b.bundle_uuid = str(uuid.UUID(bytes=raw[ix * 16:ix * 16 + 16], version=4))
 
         if self._dry_run:
             print(
-                f'Not updating bundle_uuid for {sum([len(b.uf_list) for b in bundles])} files in {len(bundles)} bundles.')
+                f'Not updating bundle_uuid for {sum(len(b.uf_list) for b in bundles)} files in {len(bundles)} bundles.')
             result = True
         else:
-            # and update the database. bundles is {bundle_uuid: [message_uuid, message_uuid, ...], ...}
-            bundles: Dict[str, List[str]] = {b.bundle_uuid: [m.message_uuid for m in b.uf_list] for b in bundles}
-            result = self._db.update_uf_bundles(programid=self._programid, deploymentnumber=self._deployment_number,
-                                                bundles=bundles)
+            # and update the database, all in one go. pairs is [(bundle_uuid, message_uuid), ...]
+            pairs: List[Tuple[str, str]] = [(b.bundle_uuid, m.message_uuid) for b in bundles for m in b.uf_list]
+            result = self._db.update_uf_bundles_bulk(programid=self._programid,
+                                                     deploymentnumber=self._deployment_number, pairs=pairs)
         return result
 
     def make_bundles(self, **kwargs):
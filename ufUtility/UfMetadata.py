@@ -1,3 +1,5 @@
+import os
+import threading
 from _testcapi import INT_MAX
 from datetime import datetime
 from pathlib import Path
@@ -10,6 +12,34 @@ from filesprocessor import FilesProcessor
 MD_MESSAGE_UUID_TAG = 'metadata.MESSAGE_UUID'
 
 
+def _compile_extractor(spec, tweak: Callable = None) -> Callable[[Dict[str, str]], str]:
+    """
+    Builds a function that extracts one column's value from a dict of properties.
+    :param spec: From uf_column_map: the property name from which to get the column's value, or a function to call
+            to get the value, or a list of property names, in priority order, of which the first one found is used.
+    :param tweak: Optional, from uf_column_tweaks_map: a function of (value, props) to adjust the value.
+    :return: a function of props that returns the column's value.
+    """
+    if isinstance(spec, str):
+        def extract(props):
+            return props.get(spec, '')
+    elif callable(spec):
+        extract = spec
+    else:
+        def extract(props):
+            for pn in spec:
+                if pn in props:
+                    return props[pn]
+            return ''
+    if tweak is None:
+        return extract
+    return lambda props: tweak(extract(props), props)
+
+
+# One extractor per column, in uf_column_map order, built once rather than interpreting the maps for every record.
+_COLUMN_EXTRACTORS: List[Callable[[Dict[str, str]], str]] = [
+    _compile_extractor(spec, uf_column_tweaks_map.get(column_name)) for column_name, spec in uf_column_map.items()]
+
 
 class UfMetadata():
     _instance = None
@@ -20,12 +50,13 @@ class UfMetadata():
             print('Creating the UfPropertiesProcessor object')
             cls._instance = super(UfMetadata, cls).__new__(cls)
             cls._props: List[Tuple] = []
+            cls._props_lock = threading.Lock()
         return cls._instance
 
     def print(self):
         print(','.join(uf_column_map.keys()))
         for line in self._props:
-            print(','.join(line))
+            print(','.join(['' if v is None else str(v) for v in line]))
 
     def commit(self):
         db = DbUtils()
@@ -37,29 +68,10 @@ class UfMetadata():
         a property for metadata.MESSAGE_UUID.
         :param props: The props to be imported.
         """
-        columns = {}
         if MD_MESSAGE_UUID_TAG in props:
-            # for each column that we want...
-            for column_name in uf_column_map.keys():
-                prop_name = uf_column_map[column_name]
-                val = ''
-                if isinstance(prop_name, str):
-                    # The property name from which to get the column's value, or ...
-                    val = props.get(prop_name, '')
-                elif callable(prop_name):
-                    # a function to call to get the column's value, or ...
-                    v = prop_name(props)
-                    columns[column_name] = v
-                else:
-                    # List of properties, in priority order. Take the first one found.
-                    for pn in prop_name:
-                        if pn in props:
-                            val = props[pn]
-                            break
-                if column_name in uf_column_tweaks_map:
-                    val = uf_column_tweaks_map[column_name](val, props)
-                columns[column_name] = val
-            self._props.append(tuple([columns[k] for k in uf_column_map.keys()]))
+            columns = tuple([extract(props) for extract in _COLUMN_EXTRACTORS])
+            with self._props_lock:
+                self._props.append(columns)
 
     def _process_file(self, path: Path) -> None:
         """
@@ -67,13 +79,12 @@ class UfMetadata():
         :param path: Path to the file to be read and processed.
         """
         props: Dict[str, str] = {}
-        with open(path, 'r') as props_file:
-            for prop_line in props_file:
-                # prop_line is like "metadata.MESSAGE_UUID=3dcff318-de4a-56db-9395-5856474f7ce2"
-                parts: List[str] = prop_line.strip().split('=', maxsplit=1)
-                if len(parts) != 2 or parts[0][0] == '#':
-                    continue
-                props[parts[0]] = parts[1]
+        # The files are small; read each in one call and split it in memory.
+        for prop_line in path.read_text().splitlines():
+            # prop_line is like "metadata.MESSAGE_UUID=3dcff318-de4a-56db-9395-5856474f7ce2"
+            key, sep, value = prop_line.strip().partition('=')
+            if sep and key and key[0] != '#':
+                props[key] = value
         self._add_props(props)
 
     def add_from_files(self, files: List[Path] = None, **kwargs) -> Tuple[int, int, int, int, int]:
@@ -91,8 +102,11 @@ class UfMetadata():
 
         processor: FilesProcessor = FilesProcessor(files)
 
-        return processor.process_files(file_acceptor, file_processor, limit=kwargs.get('limit', INT_MAX),
-                                       verbose=kwargs.get('verbose', 0), files=files)
+        # Reading many small files is mostly waiting on the file system, so read several at once.
+        workers = kwargs.get('workers', min(32, (os.cpu_count() or 1) * 4))
+        return processor.process_files(file_acceptor, file_processor, suffix='.properties',
+                                       limit=kwargs.get('limit', INT_MAX), verbose=kwargs.get('verbose', 0),
+                                       files=files, workers=workers)
 
     def add_from_dict(self, props: Dict[str, str]) -> None:
         self._add_props(props)
\ No newline at end of file
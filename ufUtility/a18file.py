@@ -1,10 +1,12 @@
+import mmap
 import platform
+import stat
 import struct
 import subprocess
 import tempfile
 import uuid as uuid
 from pathlib import Path
-from typing import Dict, Union, List, Any
+from typing import Dict, Union, List, Any, Optional
 
 import dbutils
 
@@ -18,6 +20,11 @@ PROJECT_TAG = 'PROJECT'
 RECIPIENTID_TAG = 'RECIPIENTID'
 STATS_UUID_TAG = 'collection.STATSUUID'
 NAMESPACE_UF = uuid.UUID('677aba79-e672-4fe3-91d5-c69306fe025d')
+# The bytes dropped when salvaging an ASCII string from corrupted UTF-8.
+_NON_ASCII_BYTES = bytes(b for b in range(256) if not 32 <= b <= 0x7f)
+# U+FFFD, as decoded with errors='replace', and as encoded in valid UTF-8.
+_REPLACEMENT_CHAR = '\ufffd'
+_REPLACEMENT_CHAR_UTF8 = _REPLACEMENT_CHAR.encode('utf-8')
 
 
 class BinaryReader:
@@ -25,50 +32,99 @@ class BinaryReader:
     Helper class for reading binary data, providing those functions (and only those)
     required to read TB metadata from an .a18 file.
     """
+    # Compiled once, rather than parsing the format string on every read. Adjust these if we ever need to support
+    # big-endian.
+    _I32 = struct.Struct('<l')
+    _I16 = struct.Struct('<h')
+    _I8 = struct.Struct('<b')
 
-    def __init__(self, buffer: bytes):
+    def __init__(self, buffer: Union[bytes, memoryview]):
         """
         Initialize with a bytes object; keep track of where we are in that object.
         :param buffer: bytes of metadata.
         """
-        self._buffer = buffer
+        # Strings are sliced from a memoryview, which doesn't copy; the bytes are only read when they're decoded.
+        self._buffer = memoryview(buffer)
         self._offset = 0
-        # adjust these if we ever need to support big-endian
-        self._I32 = '<l'
-        self._I16 = '<h'
-        self._I8 = '<b'
-
-    # noinspection PyShadowingBuiltins
-    def _read_x(self, format: str) -> any:
-        """
-        Read value(s) per the format string, and advance the offset (consume the data read).
-        :param format: specification of one or more values to read.
-        :return: the raw result from struct.unpack_from(), a tuple of values
-        """
-        values = struct.unpack_from(format, self._buffer, self._offset)
-        self._offset += struct.calcsize(format)
-        return values
 
     def read_i32(self) -> int:
         """
         Read a 32-bit signed integer.
         :return: the integer.
         """
-        return self._read_x(self._I32)[0]
+        value, = self._I32.unpack_from(self._buffer, self._offset)
+        self._offset += 4
+        return value
 
     def read_i16(self) -> int:
         """
         Read a 16-bit signed integer.
         :return: the integer.
         """
-        return self._read_x(self._I16)[0]
+        value, = self._I16.unpack_from(self._buffer, self._offset)
+        self._offset += 2
+        return value
 
     def read_i8(self) -> int:
         """
         Read a 8-bit signed integer.
         :return: the integer.
         """
-        return self._read_x(self._I8)[0]
+        value, = self._I8.unpack_from(self._buffer, self._offset)
+        self._offset += 1
+        return value
+
+    def skip(self, n: int) -> None:
+        """
+        Skip over (consume) data that isn't wanted.
+        :param n: the number of bytes to skip.
+        """
+        self._offset += n
+
+    def release(self) -> None:
+        """
+        Release the view of the buffer, so that the underlying object (eg, an mmap) can be closed.
+        """
+        self._buffer.release()
+
+    def read_utf8_bytes(self) -> memoryview:
+        """
+        Read the bytes of a UTF-8 encoded string, without decoding them. These are encoded as a 16-bit length,
+        followed by ${length} bytes of encoded data.
+        :return: a view of the encoded bytes.
+        """
+        str_len = self.read_i16()
+        end = self._offset + str_len
+        if str_len < 0 or end > len(self._buffer):
+            raise ValueError(f"Bad string length {str_len} at offset {self._offset} in the metadata.")
+        str_bytes: memoryview = self._buffer[self._offset:end]
+        self._offset = end
+        return str_bytes
+
+    @staticmethod
+    def decode_utf8(str_bytes: Union[bytes, memoryview]) -> str:
+        """
+        Decode UTF-8 encoded bytes, salvaging what we can if they're not valid UTF-8.
+        :param str_bytes: the encoded bytes.
+        :return: the string.
+        """
+        result = str(str_bytes, 'utf-8', 'replace')
+        if BinaryReader.is_corrupt(str_bytes, result):
+            # extract as much of an ASCII string as we can. Possibly corrupted on Talking Book.
+            return bytes(str_bytes).translate(None, _NON_ASCII_BYTES).decode('ascii')
+        return result
+
+    @staticmethod
+    def is_corrupt(str_bytes: Union[bytes, memoryview], decoded: str) -> bool:
+        """
+        Were the bytes not valid UTF-8? Every invalid sequence is decoded as U+FFFD, so there are more of those
+        in the decoded string than were actually encoded in the bytes.
+        :param str_bytes: the encoded bytes.
+        :param decoded: the bytes, decoded with errors='replace'.
+        :return: True if the bytes were not valid UTF-8.
+        """
+        return _REPLACEMENT_CHAR in decoded and \
+            decoded.count(_REPLACEMENT_CHAR) != bytes(str_bytes).count(_REPLACEMENT_CHAR_UTF8)
 
     def read_utf8(self) -> str:
         """
@@ -76,16 +132,7 @@ class BinaryReader:
         bytes of encoded data.
         :return: the string.
         """
-        str_len = self.read_i16()
-        str_format: str = f'<{str_len}s'
-        str_bytes: bytes = self._read_x(str_format)[0]
-        # noinspection PyUnusedLocal
-        try:
-            return str_bytes.decode('utf-8')
-        except Exception:
-            # extract as much of an ASCII string as we can. Possibly corrupted on Talking Book.
-            chars = [chr(b) for b in str_bytes if 32 <= b <= 0x7f]
-            return ''.join(chars)
+        return self.decode_utf8(self.read_utf8_bytes())
 
 
 class MetadataReader:
@@ -93,33 +140,36 @@ class MetadataReader:
     Class to parse .a18 metadata.
     """
 
-    def __init__(self, buffer: BinaryReader):
+    # The known metadata types. From LBMetadataIDs.java. All but STATUS are strings.
+    _MD_NAMES: Dict[int, str] = {
+        0: 'CATEGORY',
+        1: 'TITLE',
+        5: 'PUBLISHER',
+        10: 'IDENTIFIER',
+        11: 'SOURCE',
+        12: 'LANGUAGE',
+        13: 'RELATION',
+        16: 'REVISION',
+        22: 'DURATION',
+        23: 'MESSAGE_FORMAT',
+        24: 'TARGET_AUDIENCE',
+        25: 'DATE_RECORDED',
+        26: 'KEYWORDS',
+        27: 'TIMING',
+        28: 'PRIMARY_SPEAKER',
+        29: 'GOAL',
+        30: 'ENGLISH_TRANSCRIPTION',
+        31: 'NOTES',
+        32: 'BENEFICIARY',
+        33: 'STATUS',
+        35: 'SDG_GOALS',
+        36: 'SDG_TARGETS',
+    }
+    _MD_INT_IDS = frozenset({33})
+
+    def __init__(self, buffer: BinaryReader, verbose: int = 0):
         self._buffer = buffer
-        # The known metadata types. From LBMetadataIDs.java.
-        self._md_parsers = {
-            0: (self._string_md_parser, 'CATEGORY'),
-            1: (self._string_md_parser, 'TITLE'),
-            5: (self._string_md_parser, 'PUBLISHER'),
-            10: (self._string_md_parser, 'IDENTIFIER'),
-            11: (self._string_md_parser, 'SOURCE'),
-            12: (self._string_md_parser, 'LANGUAGE'),
-            13: (self._string_md_parser, 'RELATION'),
-            16: (self._string_md_parser, 'REVISION'),
-            22: (self._string_md_parser, 'DURATION'),
-            23: (self._string_md_parser, 'MESSAGE_FORMAT'),
-            24: (self._string_md_parser, 'TARGET_AUDIENCE'),
-            25: (self._string_md_parser, 'DATE_RECORDED'),
-            26: (self._string_md_parser, 'KEYWORDS'),
-            27: (self._string_md_parser, 'TIMING'),
-            28: (self._string_md_parser, 'PRIMARY_SPEAKER'),
-            29: (self._string_md_parser, 'GOAL'),
-            30: (self._string_md_parser, 'ENGLISH_TRANSCRIPTION'),
-            31: (self._string_md_parser, 'NOTES'),
-            32: (self._string_md_parser, 'BENEFICIARY'),
-            33: (self._integer_md_parser, 'STATUS'),
-            35: (self._string_md_parser, 'SDG_GOALS'),
-            36: (self._string_md_parser, 'SDG_TARGETS'),
-        }
+        self._verbose = verbose
 
     def _string_md_parser(self, joiner: str = ';'):
         """
@@ -127,12 +177,15 @@ class MetadataReader:
         :param joiner: A delimiter with which to join multiple values.
         :return: The value(s) found.
         """
-        results = []
         num_values = self._buffer.read_i8()
-        for i in range(num_values):
-            str_value = self._buffer.read_utf8()
-            results.append(str_value)
-        return joiner.join(results)
+        values = [self._buffer.read_utf8_bytes() for i in range(num_values)]
+        # Decode all the values at once, already joined. The joiner is ASCII, and can't be part of a multi-byte
+        # character, so this is the same as decoding each value and joining them, unless a value is corrupt.
+        joined = joiner.encode('utf-8').join(values)
+        result = str(joined, 'utf-8', 'replace')
+        if BinaryReader.is_corrupt(joined, result):
+            return joiner.join([BinaryReader.decode_utf8(value) for value in values])
+        return result
 
     def _integer_md_parser(self, joiner: str = ';'):
         """
@@ -160,56 +213,49 @@ class MetadataReader:
 
         for i in range(num_fields):
             field_id = self._buffer.read_i16()
-            # This isn't used because the fields all know how big they are.
-            # noinspection PyUnusedLocal
+            # The known fields all know how big they are; this is only needed to skip over unknown ones.
             field_len = self._buffer.read_i32()
 
-            if field_id in self._md_parsers:
-                fn, name = self._md_parsers.get(field_id)
-                result = fn()
-                metadata[name] = result
+            name = self._MD_NAMES.get(field_id)
+            if name is not None:
+                if field_id in self._MD_INT_IDS:
+                    metadata[name] = self._integer_md_parser()
+                else:
+                    metadata[name] = self._string_md_parser()
             else:
-                print(f'undecoded field {field_id}')
+                # Skip the field's data, so that the next field is read from the right place.
+                self._buffer.skip(field_len)
+                if self._verbose > 0:
+                    print(f'undecoded field {field_id}')
         return metadata
 
     @staticmethod
-    def read_from_file(a18_path: Path) -> Dict[str, str]:
+    def read_from_file(a18_path: Path, verbose: int = 0) -> Dict[str, str]:
         """
         Extract the metadata from an .a18 file. The file consists of a 32-bit length-of-audio-data, length bytes of
         audio data, bytes-til-eof of metadata
         :param a18_path: path to the .a18 file.
+        :param verbose: if > 0, report any fields that aren't known.
         :return: a Dict[str,str] of the metadata
         """
-
-        def _t(a, b, c):
-            """
-            return a ? b : c
-            :param a: The condition.
-            :param b: Value if True.
-            :param c: Value if False.
-            :return: the value.
-            """
-            return b if a else c
-
-        file_len = a18_path.stat().st_size
-        with open(a18_path, 'rb') as f:
+        # The file is mapped rather than read, so the metadata is parsed directly from the page cache, with no copy.
+        with open(a18_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
             # First 4 bytes is unsigned long 'size of audio'. Skip the audio, load the binary metadata.
-            buffer = f.read(4)
-            audio_len = struct.unpack('<l', buffer)[0]
-            buffer = f.read(2)
-            audio_bps = struct.unpack('<h', buffer)[0]
+            audio_len = int.from_bytes(mm[0:4], 'little', signed=True)
+            audio_bps = int.from_bytes(mm[4:6], 'little', signed=True)
 
             md_offset = audio_len + 4
-            md_len = file_len - md_offset
-            f.seek(md_offset)
-            md_bytes = f.read(md_len)
-        bytes_reader = BinaryReader(md_bytes)
-        md_parser = MetadataReader(bytes_reader)
-        md: Dict[str, str] = md_parser.parse()
+            # Every view of the map must be released before it can be closed.
+            with memoryview(mm)[md_offset:] as md_bytes:
+                bytes_reader = BinaryReader(md_bytes)
+                try:
+                    md: Dict[str, str] = MetadataReader(bytes_reader, verbose).parse()
+                finally:
+                    bytes_reader.release()
         total_seconds = int(audio_len * 8 / audio_bps + 0.5)
         if 'DURATION' not in md:
             minutes, seconds = divmod(total_seconds, 60)
-            duration = f'{minutes:02}:{seconds:02} {_t(audio_bps == 16000, "l", "h")}'
+            duration = f'{minutes:02}:{seconds:02} {"l" if audio_bps == 16000 else "h"}'
             md['DURATION'] = duration
         if 'SECONDS' not in md:
             md['SECONDS'] = str(total_seconds)
@@ -233,6 +279,8 @@ class A18File:
         self._db_utils = dbutils.DbUtils()
         self._file_path: Path = file_path
         self._metadata: Union[Dict[str, str], None] = None
+        # The sorted, joined metadata values, for the message uuid. Reset whenever the metadata changes.
+        self._md_sorted_string: Optional[str] = None
         self._sidecar_needs_save = False
         self._sidecar_data: Dict[str, str] = {}
         self._sidecar_header: List[str] = []
@@ -245,7 +293,8 @@ class A18File:
     @property
     def metadata(self) -> Dict[str, str]:
         if self._metadata is None:
-            self._metadata = MetadataReader.read_from_file(self._file_path)
+            self._metadata = MetadataReader.read_from_file(self._file_path, self._verbose)
+            self._md_sorted_string = None
         return self._metadata
 
     @property
@@ -256,6 +305,20 @@ class A18File:
     def has_sidecar(self) -> bool:
         return self.sidecar_path.exists()
 
+    def sidecar_is_current(self) -> bool:
+        """
+        Is there a sidecar at least as new as the .a18 file, with the values that update_sidecar() adds only
+        once (the message uuid and the deployment number)? Answered from the file times and the sidecar itself,
+        without reading the .a18 metadata or querying the database.
+        :return: True if the sidecar is current.
+        """
+        try:
+            if self.sidecar_path.stat().st_mtime < self._file_path.stat().st_mtime:
+                return False
+        except FileNotFoundError:
+            return False
+        return bool(self.property(MD_MESSAGE_UUID_TAG)) and bool(self.property(DEPLOYMENT_NUMBER_TAG))
+
     def property(self, name: str, default: str = None) -> Any:
         if not self._sidecar_loaded:
             self._load_sidecar()
@@ -267,11 +330,25 @@ class A18File:
             try:
                 if not self._sidecar_loaded and not creating:
                     self._load_sidecar()
+                # The sidecar is loaded now; read it directly, rather than through property(). add_to_sidecar()
+                # updates this same dict.
+                sidecar_data = self._sidecar_data
+
+                # If the sidecar already has this file's metadata and message uuid (as on a re-run), take the
+                # metadata from there, rather than parsing the .a18 file again. Without the uuid, the metadata is
+                # read from the .a18 file: the sidecar's values have been stripped, and would give a different uuid.
+                if self._metadata is None and sidecar_data.get(MD_MESSAGE_UUID_TAG) and \
+                        sidecar_data.get('metadata.filename') == self._file_path.stem:
+                    self._metadata = {k[9:]: v for k, v in sidecar_data.items()
+                                      if k.startswith('metadata.') and k != MD_MESSAGE_UUID_TAG}
+                    self._md_sorted_string = None
 
                 # Add the filename to the metadata. It's little different from "IDENTIFIED", by having "_9-0_"
                 # in the filename.
                 metadata = self.metadata
-                metadata['filename'] = self._file_path.stem
+                if metadata.get('filename') != self._file_path.stem:
+                    metadata['filename'] = self._file_path.stem
+                    self._md_sorted_string = None
 
                 # Ensure the a18 metadata is in the sidecar, tagged with 'metadata.' This operation is idempotent
                 # because the metadata values are constant.
@@ -280,18 +357,18 @@ class A18File:
                 # Compute a message UUID based on the collection's STATSUUID and all the metadata. If no STATSUUID
                 # or no metadata, allocate a new UUID. (Note that the metadata will include the file name added
                 # above.)
-                if not self.property(MD_MESSAGE_UUID_TAG):  # includes 'metadata.' tag.
+                if not sidecar_data.get(MD_MESSAGE_UUID_TAG):  # includes 'metadata.' tag.
                     self.add_to_sidecar({MD_MESSAGE_UUID_TAG: str(self._compute_message_uuid())})
 
                 # Ensure deployment number is in the sidecar. This is performed at most one time.
-                if not self.property(DEPLOYMENT_NUMBER_TAG):
-                    deployment_number = self._db_utils.query_deployment_number(self.property(PROJECT_TAG),
-                                                                               self.property(DEPLOYMENT_TAG))
+                if not sidecar_data.get(DEPLOYMENT_NUMBER_TAG):
+                    deployment_number = self._db_utils.query_deployment_number(sidecar_data.get(PROJECT_TAG),
+                                                                               sidecar_data.get(DEPLOYMENT_TAG))
                     self.add_to_sidecar({DEPLOYMENT_NUMBER_TAG: deployment_number})
 
                 # Ensure the recipient info is in the sidecar, tagged with 'recipient.' This operation is not idempotent
                 # because the recipient values on the server could have changed.
-                recipient_info = self._db_utils.query_recipient_info(self.property(RECIPIENTID_TAG))
+                recipient_info = self._db_utils.query_recipient_info(sidecar_data.get(RECIPIENTID_TAG))
                 self.add_to_sidecar(recipient_info, 'recipient')
 
                 if save:
@@ -336,12 +413,14 @@ class A18File:
         with open(self.sidecar_path, "r") as sidecar_file:
             for line in sidecar_file:
                 line = line.strip()
+                if not line:
+                    continue
                 if line[0] == '#':
                     header.append(line)
                 else:
-                    parts = line.split('=', maxsplit=1)
-                    if len(parts) == 2:
-                        props[parts[0].strip()] = parts[1].strip()
+                    key, sep, value = line.partition('=')
+                    if sep:
+                        props[key.strip()] = value.strip()
         self._sidecar_needs_save = False
         self._sidecar_loaded = True
         self._sidecar_header = header
@@ -358,21 +437,21 @@ class A18File:
         """
         if save_as is None and extra_data is not None:
             raise (ValueError('extra_data without save_as'))
-        to_write = {k: v for k, v in self._sidecar_data.items()}
+        # Only copy the data if there is something to add to it.
+        if extra_data:
+            to_write = self._sidecar_data.copy()
+            to_write.update(extra_data)
+        else:
+            to_write = self._sidecar_data
         if self._sidecar_needs_save or save_as:
-            if extra_data:
-                for k, v in extra_data.items():
-                    to_write[k] = v
             save_path: Path = save_as or self.sidecar_path
             if self._dry_run:
                 print(f'Dry run, not saving sidecar \'{str(save_path)}\'.')
             else:
                 temp_path = save_path.with_suffix('.new')
+                lines = self._sidecar_header + [f'{k}={to_write[k]}' for k in sorted(to_write.keys())]
                 with open(temp_path, "w") as properties_file:
-                    for h in self._sidecar_header:
-                        print(h, file=properties_file, end='\x0d\x0a')  # microsoft's original sin
-                    for k in sorted(to_write.keys()):
-                        print(f'{k}={to_write[k]}', file=properties_file, end='\x0d\x0a')
+                    properties_file.write(''.join(f'{line}\x0d\x0a' for line in lines))  # microsoft's original sin
                 temp_path.replace(save_path)
             # If we saved to the default location, the metadata is no longer "dirty".
             if save_as is not None:
@@ -413,21 +492,29 @@ class A18File:
         target_path = target_path.with_suffix(audio_format)
         target_name: str = target_path.name
 
-        tdp = Path(target_dir, '.')
-        print(f'Target dir: {target_dir}, exists:{target_dir.exists()}, is_dir:{target_dir.is_dir()}')
-        print(f'tdp dir: {tdp}, exists:{tdp.exists()}, is_dir:{tdp.is_dir()}')
+        # One stat of the target directory answers whether it exists, and whether it's a directory or a file.
+        try:
+            target_mode = target_dir.stat().st_mode
+        except (FileNotFoundError, NotADirectoryError):
+            target_mode = None
+        target_exists = target_mode is not None
+        target_is_dir = target_exists and stat.S_ISDIR(target_mode)
+        target_is_file = target_exists and stat.S_ISREG(target_mode)
+
+        if self._verbose > 1:
+            print(f'Target dir: {target_dir}, exists:{target_exists}, is_dir:{target_is_dir}')
 
-        if not target_dir.exists() and not mk_dirs:
+        if not target_exists and not mk_dirs:
             print(f'Target directory does not exist: \'{str(target_dir)}\'.')
             return None
-        elif target_dir.is_file():
+        elif target_is_file:
             print(f'Target \'{str(target_dir)}\' is not a directory.')
             return None
         elif self._dry_run:
             print(f'Dry run, not exporting audio as \'{str(target_path)}\'.')
             return target_path
 
-        if not target_dir.exists():
+        if not target_exists:
             target_dir.mkdir(parents=True, exist_ok=True)
 
         if self._local_ffmpeg:
@@ -480,7 +567,9 @@ class A18File:
         should be unique, as it has the
         :return:
         """
-        metadata_string = ''.join(sorted(self._metadata.values()))
+        if self._md_sorted_string is None:
+            self._md_sorted_string = ''.join(sorted(self._metadata.values()))
+        metadata_string = self._md_sorted_string
         collection_id = self.property(STATS_UUID_TAG, '')
         if metadata_string:
             message_id = uuid.uuid5(NAMESPACE_UF, collection_id + metadata_string)
@@ -1,7 +1,13 @@
 import base64
+import io
 import json
+import queue
+import threading
 import time
-from typing import Dict, List, Union, Tuple, Any
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, List, Union, Tuple, Any, Iterable, Iterator, Optional
 
 import boto3 as boto3
 import pg8000 as pg8000
@@ -10,18 +16,125 @@ from pg8000 import Cursor, Connection
 
 from UfRecord import uf_column_map, UfRecord
 
-recipient_cache: Dict[str, Dict[str, str]] = {}
+# Recipients already looked up (empty if not found), least recently used first. Bounded, so a long run doesn't
+# grow it forever, and guarded, because recipients are looked up from several threads at once.
+recipient_cache: 'OrderedDict[str, Dict[str, str]]' = OrderedDict()
+_recipient_cache_lock = threading.Lock()
+RECIPIENT_CACHE_SIZE = 10_000
+# The recipient columns of interest. { db column : dict key }
+RECIPIENT_COLUMNS = {'recipientid': 'recipientid', 'project': 'program', 'partner': 'customer',
+                     'affiliate': 'affiliate', 'country': 'country', 'region': 'region',
+                     'district': 'district', 'communityname': 'community', 'groupname': 'group', 'agent': 'agent',
+                     'language': 'language', 'listening_model': 'listening_model'}
+RECIPIENT_KEYS: List[str] = list(RECIPIENT_COLUMNS.values())
+
+# The text of each statement is built once. pg8000 keeps each connection's prepared statements keyed by their text,
+# so a statement that's run again is neither re-built here nor re-parsed and re-planned by the server.
+# select recipientid, project, ... from recipients where recipientid = '0123abcd4567efgh';
+QUERY_RECIPIENT_SQL = f'select {",".join(RECIPIENT_COLUMNS.keys())} from recipients where recipientid=:recipientid;'
+PREFETCH_RECIPIENTS_SQL = f'select {",".join(RECIPIENT_COLUMNS.keys())} from recipients ' \
+                          f'where recipientid=ANY(:recipientids);'
+QUERY_DEPLOYMENT_NUMBER_SQL = 'select deploymentnumber from deployments where project=:program and ' \
+                              'deployment=:deployment limit 1;'
+
+
+@lru_cache(maxsize=64)
+def _uf_insert_sql(columns: Tuple[str, ...], n_rows: int) -> str:
+    """
+    An INSERT of n_rows rows into uf_messages, with numeric parameters.
+    :param columns: The columns, in the order of the values in the records.
+    :param n_rows: How many rows the statement inserts.
+    :return: the statement's text.
+    """
+    n_columns = len(columns)
+    values = ', '.join(
+        ['(' + ', '.join([f':{row * n_columns + ix + 1}' for ix in range(n_columns)]) + ')' for row in range(n_rows)])
+    return f"INSERT INTO uf_messages ({', '.join(columns)}) VALUES {values} ON CONFLICT(message_uuid) DO NOTHING;"
+
+
+@lru_cache(maxsize=64)
+def _uf_bundle_update_sql(n_rows: int, message_uuid_type: str, bundle_uuid_type: str) -> str:
+    """
+    An UPDATE of n_rows messages' bundle_uuid, with numeric parameters: the (message_uuid, bundle_uuid) pairs,
+    then the programid and deploymentnumber.
+    :param n_rows: How many messages the statement updates.
+    :param message_uuid_type: The type of the message_uuid column.
+    :param bundle_uuid_type: The type of the bundle_uuid column.
+    :return: the statement's text.
+    """
+    # The values would otherwise be taken as text; cast them to the columns' own types.
+    values = ', '.join([f'(CAST(:{2 * ix + 1} AS {message_uuid_type}), CAST(:{2 * ix + 2} AS {bundle_uuid_type}))'
+                        for ix in range(n_rows)])
+    n_params = 2 * n_rows
+    return f"UPDATE uf_messages SET bundle_uuid=v.bundle_uuid " \
+           f"FROM (VALUES {values}) AS v(message_uuid, bundle_uuid) " \
+           f"WHERE uf_messages.message_uuid=v.message_uuid " \
+           f"AND programid=:{n_params + 1} AND deploymentnumber=:{n_params + 2};"
+
+# {(table, column): type}, from the database's catalog.
+column_types: Dict[Tuple[str, str], str] = {}
+
+# Idle database connections, ready for use. Connections are created as needed, up to MAX_DB_CONNECTIONS, so that
+# several threads can each have a connection of their own.
+_db_connections: 'queue.Queue[Connection]' = queue.Queue()
+_num_db_connections = 0
+MAX_DB_CONNECTIONS = 8
+
+# The database credentials, from the secrets manager, and when they were fetched. They're re-fetched after
+# SECRET_TTL seconds, in case they've been rotated.
+_secret: Union[dict, None] = None
+_secret_time: float = 0
+_secret_lock = threading.Lock()
+SECRET_TTL = 3600
+# The PostgreSQL protocol's limit on the number of parameters in one statement, as a signed 16-bit count.
+MAX_QUERY_PARAMETERS = 32767
+# At least this many uf records are loaded with COPY, rather than INSERT.
+COPY_THRESHOLD = 1000
+# How many messages to update with each UPDATE ... FROM (VALUES ...) statement.
+UPDATE_BATCH_SIZE = 5000
+COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\r': '\\r', '\n': '\\n'})
+# Guards creation of the DbUtils singleton and of the connections, which may first be wanted from several threads.
+_init_lock = threading.Lock()
+
+
+def _get_cached_recipient(recipientid: str) -> Optional[Dict[str, str]]:
+    """
+    Gets a recipient from the cache, marking it as recently used.
+    :param recipientid: to be found.
+    :return: the cached recipient info, or None if the recipient hasn't been looked up.
+    """
+    with _recipient_cache_lock:
+        recipient_info = recipient_cache.get(recipientid)
+        if recipient_info is not None:
+            recipient_cache.move_to_end(recipientid)
+        return recipient_info
+
 
-_db_connection: Union[Connection, None] = None
+def _cache_recipients(recipients: Dict[str, Dict[str, str]]) -> None:
+    """
+    Adds recipients to the cache, evicting the least recently used ones beyond RECIPIENT_CACHE_SIZE.
+    :param recipients: { recipientid : recipient info }
+    """
+    with _recipient_cache_lock:
+        for recipientid, recipient_info in recipients.items():
+            recipient_cache[recipientid] = recipient_info
+            recipient_cache.move_to_end(recipientid)
+        while len(recipient_cache) > RECIPIENT_CACHE_SIZE:
+            recipient_cache.popitem(last=False)
 
 
 # noinspection SqlDialectInspection ,SqlNoDataSourceInspection
 class DbUtils:
     _instance = None
 
-    # This class is a singleton. 
+    # This class is a singleton. Every DbUtils() after the first returns the same object, and so shares the one
+    # pool of database connections.
     def __new__(cls, **kwargs):
-        if cls._instance is None:
+        if cls._instance is not None:
+            return cls._instance
+        with _init_lock:
+            if cls._instance is not None:
+                return cls._instance
             print('Creating the DbUtils object')
             cls._instance = super(DbUtils, cls).__new__(cls)
             cls._props: List[Tuple] = []
@@ -35,6 +148,18 @@ class DbUtils:
         return cls._instance
 
     def _get_secret(self) -> dict:
+        """
+        Gets the database credentials, from a cached copy if it's recent enough.
+        :return: the secret.
+        """
+        global _secret, _secret_time
+        with _secret_lock:
+            if _secret is None or time.monotonic() - _secret_time >= SECRET_TTL:
+                _secret = self._fetch_secret()
+                _secret_time = time.monotonic()
+            return _secret
+
+    def _fetch_secret(self) -> dict:
         secret_name = "lb_stats_access2"
         region_name = "us-west-2"
 
@@ -101,115 +226,222 @@ class DbUtils:
         # Your code goes here.
         return result
 
-    def _get_db_connection(self) -> None:
-        global _db_connection
-        if _db_connection is None:
-            secret = self._get_secret()
-
-            parms = {'database': 'dashboard', 'user': secret['username'], 'password': secret['password'],
-                     'host': secret['host'], 'port': secret['port']}
-            if self._db_host:
-                parms['host'] = self._db_host
-            if self._db_port:
-                parms['port'] = int(self._db_port)
-            if self._db_user:
-                parms['user'] = self._db_user
-            if self._db_password:
-                parms['password'] = self._db_password
-            if self._db_name:
-                parms['database'] = self._db_name
-
-            _db_connection = pg8000.connect(**parms)
-
-    @property
-    def db_connection(self) -> Connection:
-        global _db_connection
-        if not _db_connection:
-            self._get_db_connection()
-        return _db_connection
+    def _get_db_parms(self) -> Dict[str, Any]:
+        secret = self._get_secret()
+
+        parms = {'database': 'dashboard', 'user': secret['username'], 'password': secret['password'],
+                 'host': secret['host'], 'port': secret['port']}
+        if self._db_host:
+            parms['host'] = self._db_host
+        if self._db_port:
+            parms['port'] = int(self._db_port)
+        if self._db_user:
+            parms['user'] = self._db_user
+        if self._db_password:
+            parms['password'] = self._db_password
+        if self._db_name:
+            parms['database'] = self._db_name
+        return parms
+
+    @contextmanager
+    def acquire(self) -> Iterator[Connection]:
+        """
+        Borrow a database connection for the duration of a 'with' block. An idle connection is reused if there is
+        one; otherwise a new one is opened, or, if there are already MAX_DB_CONNECTIONS, this waits for one to be
+        returned. Any transaction the block leaves open (a read, or a failure) is rolled back before the connection
+        is returned, so every borrower starts with a fresh transaction; writers must commit their own work.
+        :return: the connection.
+        """
+        global _num_db_connections
+        # The pool holds idle connections, and None for a slot whose connection broke (or couldn't be opened),
+        # which the next borrower fills with a new connection.
+        try:
+            connection = _db_connections.get_nowait()
+        except queue.Empty:
+            with _init_lock:
+                can_connect = _num_db_connections < MAX_DB_CONNECTIONS
+                if can_connect:
+                    _num_db_connections += 1
+            connection = None if can_connect else _db_connections.get()
+        if connection is None:
+            try:
+                connection = pg8000.connect(**self._get_db_parms())
+                connection.autocommit = False
+            except Exception:
+                # Give the slot back, so that a waiting borrower can try.
+                _db_connections.put(None)
+                raise
+        try:
+            yield connection
+        finally:
+            # Outside of a transaction, the rollback is a cheap no-op.
+            try:
+                connection.rollback()
+            except Exception:
+                # The connection is broken; drop it. Its slot goes back to the pool, which wakes any borrower
+                # waiting for a connection, to open a new one in its place.
+                connection = None
+            _db_connections.put(connection)
 
     def query_recipient_info(self, recipientid: str) -> Dict[str, str]:
         """
         Given a recipientid, return information about the recipient. Previously found recipients are
         cached. Non-cached recipients are looked up in the database.
         :param recipientid: to be found.
-        :return: a Dict[str,str] of data about the recipient.
+        :return: a Dict[str,str] of data about the recipient, the caller's own copy.
         """
-        if recipientid in recipient_cache:
-            return recipient_cache[recipientid]
+        recipient_info = _get_cached_recipient(recipientid)
+        if recipient_info is not None:
+            return dict(recipient_info)
 
-        cursor: Cursor = self.db_connection.cursor()
-        cursor.paramstyle = 'named'
+        with self.acquire() as db_connection:
+            cursor: Cursor = db_connection.cursor()
+            cursor.paramstyle = 'named'
 
-        # { db column : dict key }
-        columns = {'recipientid': 'recipientid', 'project': 'program', 'partner': 'customer', 'affiliate': 'affiliate',
-                   'country': 'country', 'region': 'region',
-                   'district': 'district', 'communityname': 'community', 'groupname': 'group', 'agent': 'agent',
-                   'language': 'language', 'listening_model': 'listening_model'}
-        # select recipientid, project, ... from recipients where recipientid = '0123abcd4567efgh';
-        command = f'select {",".join(columns.keys())} from recipients where recipientid=:recipientid;'
-        values = {'recipientid': recipientid}
+            command = QUERY_RECIPIENT_SQL
+            values = {'recipientid': recipientid}
 
-        recipient_info: Dict[str, str] = {}
-        try:
-            result_keys: List[str] = list(columns.values())
-            cursor.execute(command, values)
+            recipient_info: Dict[str, str] = {}
+            try:
+                cursor.execute(command, values)
+                row = cursor.fetchone()
+                # Copy the recipient info, translating from the database names to the local names.
+                recipient_info = dict(zip(RECIPIENT_KEYS, row)) if row else {}
+            except Exception:
+                pass
+            _cache_recipients({recipientid: recipient_info})
+            return dict(recipient_info)
+
+    def prefetch_recipients(self, recipientids: Iterable[str]) -> None:
+        """
+        Look up, with a single query, all of the given recipients that aren't already cached, and cache them. Any
+        that aren't found are cached as empty, as query_recipient_info does.
+        :param recipientids: to be found.
+        """
+        missing = [recipientid for recipientid in set(recipientids) if
+                   recipientid and _get_cached_recipient(recipientid) is None]
+        if not missing:
+            return
+
+        with self.acquire() as db_connection:
+            cursor: Cursor = db_connection.cursor()
+            cursor.paramstyle = 'named'
+            cursor.execute(PREFETCH_RECIPIENTS_SQL, {'recipientids': missing})
+            found: Dict[str, Dict[str, str]] = {}
             for row in cursor:
                 # Copy the recipient info, translating from the database names to the local names.
-                for key in result_keys:
-                    recipient_info[key] = row[result_keys.index(key)]
-        except Exception:
-            pass
-        recipient_cache[recipientid] = recipient_info
-        return recipient_info
+                recipient_info = dict(zip(RECIPIENT_KEYS, row))
+                found[recipient_info['recipientid']] = recipient_info
+        if self._verbose >= 1:
+            print(f'Prefetched {len(found)} of {len(missing)} recipients.')
+        _cache_recipients({recipientid: found.get(recipientid, {}) for recipientid in missing})
 
     def query_deployment_number(self, program: str, deployment: str) -> str:
-        cursor: Cursor = self.db_connection.cursor()
-        cursor.paramstyle = 'named'
+        with self.acquire() as db_connection:
+            cursor: Cursor = db_connection.cursor()
+            cursor.paramstyle = 'named'
 
-        command = 'select deploymentnumber from deployments where project=:program and deployment=:deployment limit 1;'
-        values = {'program': program, 'deployment': deployment}
+            command = QUERY_DEPLOYMENT_NUMBER_SQL
+            values = {'program': program, 'deployment': deployment}
 
-        cursor.execute(command, values)
-        for row in cursor:
-            return str(row[0])
+            cursor.execute(command, values)
+            for row in cursor:
+                return str(row[0])
 
     def insert_uf_records(self, uf_items: List[Tuple]) -> Any:
-        cursor: Cursor = self.db_connection.cursor()
-        cursor.paramstyle = 'numeric'
-        if self._verbose >= 1:
-            print(f'Adding {len(uf_items)} records to uf_messages')
-
-        # It doesn't seem that this should be necessary, but it seems to be.
-        self.db_connection.rollback()
-
-        columns = list(uf_column_map.keys())
-        column_numbers = [f':{ix + 1}' for ix in range(0, len(columns))]
-
-        command = f"INSERT INTO uf_messages " \
-                  f"({', '.join(columns)}) VALUES ({', '.join(column_numbers)})" \
-                  f"ON CONFLICT(message_uuid) DO NOTHING;"
-        for uf_item in uf_items:
-            cursor.execute(command, uf_item)
+        with self.acquire() as db_connection:
+            cursor: Cursor = db_connection.cursor()
+            cursor.paramstyle = 'numeric'
+            if self._verbose >= 1:
+                print(f'Adding {len(uf_items)} records to uf_messages')
+
+            # Don't wait for the WAL flush at commit. If the server crashes in the following moment, the
+            # last batch may be lost (never corrupted); the files are still on disk and can simply be re-imported.
+            cursor.execute('SET LOCAL synchronous_commit = off;')
+
+            columns = list(uf_column_map.keys())
+            if len(uf_items) >= COPY_THRESHOLD:
+                self._copy_uf_records(cursor, columns, uf_items)
+            else:
+                self._insert_uf_records(cursor, columns, uf_items)
 
-        self.db_connection.commit()
-        if self._verbose >= 2:
-            print(f'Committed {len(uf_items)} records to uf_messages.')
+            db_connection.commit()
+            if self._verbose >= 2:
+                print(f'Committed {len(uf_items)} records to uf_messages.')
 
-    def get_uf_records(self, programid: str, deploymentnumber: int) -> List[UfRecord]:
-        cursor: Cursor = self.db_connection.cursor()
-        cursor.paramstyle = 'named'
-        if self._verbose >= 1:
-            print(f'Getting uf records for {programid} / {deploymentnumber}.')
-
-        result = []
-        command = f"SELECT " + ', '.join(uf_column_map.keys()) + \
-                  f" FROM uf_messages WHERE programid=:programid AND deploymentnumber=:deploymentnumber ORDER BY message_uuid;"
-        options = {'programid': programid, 'deploymentnumber': deploymentnumber}
-        cursor.execute(command, options)
-        for row in cursor:
-            result.append(UfRecord(*row))
-        return result
+    @staticmethod
+    def _copy_uf_records(cursor: Cursor, columns: List[str], uf_items: List[Tuple]) -> None:
+        """
+        Loads the records with COPY, which streams the rows with no per-row parsing or planning. COPY can't skip
+        rows that already exist, so the rows are copied to a temporary table, and inserted from there.
+        :param cursor: On which to run the commands. The caller commits, which drops the temporary table.
+        :param columns: The uf_messages columns, in the order of the values in the records.
+        :param uf_items: The records to be loaded.
+        """
+        # COPY's text format: tab separated, \N for NULL, and backslash escapes for backslash, tab, CR and LF.
+        def copy_value(value: Any) -> str:
+            if value is None:
+                return '\\N'
+            return str(value).translate(COPY_TEXT_ESCAPES)
+
+        rows = io.StringIO(''.join(['\t'.join([copy_value(v) for v in uf_item]) + '\n' for uf_item in uf_items]))
+        column_list = ', '.join(columns)
+        cursor.execute("CREATE TEMP TABLE uf_staging (LIKE uf_messages INCLUDING DEFAULTS) ON COMMIT DROP;")
+        cursor.execute(f"COPY uf_staging ({column_list}) FROM STDIN;", stream=rows)
+        cursor.execute(f"INSERT INTO uf_messages ({column_list}) SELECT {column_list} FROM uf_staging "
+                       f"ON CONFLICT(message_uuid) DO NOTHING;")
+
+    @staticmethod
+    def _insert_uf_records(cursor: Cursor, columns: List[str], uf_items: List[Tuple]) -> None:
+        """
+        Inserts the records with multi-row INSERT statements.
+        :param cursor: On which to run the commands. The caller commits.
+        :param columns: The uf_messages columns, in the order of the values in the records.
+        :param uf_items: The records to be inserted.
+        """
+        # Insert many rows with each statement, as many as fit within the limit on the number of parameters.
+        rows_per_insert = MAX_QUERY_PARAMETERS // len(columns)
+        for start in range(0, len(uf_items), rows_per_insert):
+            batch = uf_items[start:start + rows_per_insert]
+            command = _uf_insert_sql(tuple(columns), len(batch))
+            cursor.execute(command, [value for uf_item in batch for value in uf_item])
+
+    def get_uf_records(self, programid: str, deploymentnumber: int, min_seconds: int = None, max_seconds: int = None,
+                       only_unbundled: bool = False) -> List[UfRecord]:
+        """
+        Gets the uf_messages records of a deployment, optionally only those meeting some criteria. The criteria are
+        applied by the database, so rows that aren't wanted are never sent.
+        :param programid: The program of interest.
+        :param deploymentnumber: The deployment of interest.
+        :param min_seconds: If given, only messages at least this long.
+        :param max_seconds: If given, only messages at most this long.
+        :param only_unbundled: If True, only messages that have not yet been assigned to a bundle.
+        :return: A list of the records, ordered by message_uuid.
+        """
+        with self.acquire() as db_connection:
+            cursor: Cursor = db_connection.cursor()
+            cursor.paramstyle = 'named'
+            if self._verbose >= 1:
+                print(f'Getting uf records for {programid} / {deploymentnumber}.')
+
+            result = []
+            conditions = ['programid=:programid', 'deploymentnumber=:deploymentnumber']
+            options = {'programid': programid, 'deploymentnumber': deploymentnumber}
+            if min_seconds is not None:
+                conditions.append('length_seconds>=:min_seconds')
+                options['min_seconds'] = min_seconds
+            if max_seconds is not None:
+                conditions.append('length_seconds<=:max_seconds')
+                options['max_seconds'] = max_seconds
+            if only_unbundled:
+                # An empty bundle_uuid has always been treated the same as a missing one.
+                conditions.append("COALESCE(bundle_uuid::text, '')=''")
+            command = f"SELECT " + ', '.join(uf_column_map.keys()) + \
+                      f" FROM uf_messages WHERE {' AND '.join(conditions)} ORDER BY message_uuid;"
+            cursor.execute(command, options)
+            for row in cursor:
+                result.append(UfRecord(*row))
+            return result
 
     def update_uf_bundles(self, programid: str, deploymentnumber: int, bundles: Dict[str,List[str]]) -> bool:
         """
@@ -219,20 +451,53 @@ class DbUtils:
         :param bundles: A map of bundle_uuid to list of message_uuid.
         :return: pass/fail
         """
-        cursor: Cursor = self.db_connection.cursor()
-        cursor.paramstyle = 'named'
-        if self._verbose >= 1:
-            print(f'Updating uf bundle_uuids for {sum([len(v) for v in bundles.values()])} messages in {programid} / {deploymentnumber}.')
+        pairs = [(bundle_uuid, message_uuid) for bundle_uuid, messages in bundles.items() for message_uuid in messages]
+        return self.update_uf_bundles_bulk(programid, deploymentnumber, pairs)
 
-        try:
-            command = "UPDATE uf_messages SET bundle_uuid=:bundle_uuid WHERE message_uuid=:message_uuid AND programid=:programid AND deploymentnumber=:deploymentnumber;"
-            options = {'programid': programid, 'deploymentnumber': deploymentnumber}
-            for bundle_uuid, messages in bundles.items():
-                options['bundle_uuid'] = bundle_uuid
-                for message_uuid in messages:
-                    options['message_uuid'] = message_uuid
-                    cursor.execute(command, options)
-            self.db_connection.commit()
-            return True
-        except Exception as ex:
-            return False
+    def update_uf_bundles_bulk(self, programid: str, deploymentnumber: int, pairs: List[Tuple[str, str]]) -> bool:
+        """
+        Updates the bundle_uuid column of the inidicated messages. Each statement updates many messages, joined
+        to a VALUES list of (message_uuid, bundle_uuid), and all are committed as a single transaction.
+        :param programid: For an extra validation, the record must belong to this program.
+        :param deploymentnumber: For an extra validation, the record must belong to this deployment.
+        :param pairs: A list of (bundle_uuid, message_uuid).
+        :return: pass/fail
+        """
+        with self.acquire() as db_connection:
+            cursor: Cursor = db_connection.cursor()
+            cursor.paramstyle = 'numeric'
+            if self._verbose >= 1:
+                print(f'Updating uf bundle_uuids for {len(pairs)} messages in {programid} / {deploymentnumber}.')
+
+            try:
+                # As for insert_uf_records; a lost update leaves the messages un-bundled, to be bundled again.
+                cursor.execute('SET LOCAL synchronous_commit = off;')
+                message_uuid_type = self._get_column_type(cursor, 'uf_messages', 'message_uuid')
+                bundle_uuid_type = self._get_column_type(cursor, 'uf_messages', 'bundle_uuid')
+                for start in range(0, len(pairs), UPDATE_BATCH_SIZE):
+                    batch = pairs[start:start + UPDATE_BATCH_SIZE]
+                    command = _uf_bundle_update_sql(len(batch), message_uuid_type, bundle_uuid_type)
+                    params = [value for bundle_uuid, message_uuid in batch for value in (message_uuid, bundle_uuid)]
+                    cursor.execute(command, params + [programid, deploymentnumber])
+                db_connection.commit()
+                return True
+            except Exception as ex:
+                print(f'Exception updating uf bundle_uuids for {programid} / {deploymentnumber}: {ex}')
+                db_connection.rollback()
+                return False
+
+    @staticmethod
+    def _get_column_type(cursor: Cursor, table: str, column: str) -> str:
+        """
+        Gets the declared type of a column, like 'uuid' or 'character varying(36)'. Looked up once, then cached.
+        :param cursor: On which to query the catalog.
+        :param table: The table of interest.
+        :param column: The column of interest.
+        :return: The column's type, suitable for a CAST.
+        """
+        key = (table, column)
+        if key not in column_types:
+            cursor.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                           "WHERE attrelid=CAST(:1 AS regclass) AND attname=:2;", [table, column])
+            column_types[key] = cursor.fetchone()[0]
+        return column_types[key]
@@ -9,13 +9,19 @@ in all the directories, and in all of their sub-directories, etc.
 For each file, call a predicate to determine whether to process or skip the file,
 and if "process", call a passed function to perform the processing.
 """
+import os
+import stat
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Callable, Tuple, Any
+from typing import List, Callable, Tuple, Any, Deque, Union
 
 
 class FilesProcessor:
     def __init__(self, files: List[Path]):
         self._files = files
+        # The files and directories as given, to tell a missing given file from one that's vanished in the walk.
+        self._original = frozenset(files)
 
     def process_files(self, acceptor: Callable[[Path], bool] = lambda x: True,
                       processor: Callable[[Path], Any] = lambda x: None,
@@ -24,25 +30,64 @@ class FilesProcessor:
         Given a list Paths to a file or directory containing, process the file(s).
         :param file_specs: A list of Pathss
         :param acceptor: a callback to determine if a file should be processed. Default returns true.
+        :param suffix: (keyword) if given, files whose names don't end with this suffix (ignoring case) are skipped
+            without building a Path for them or calling the acceptor.
+        :param workers: (keyword) if more than 1, the processor is called on this many threads at once, so it must
+            be thread safe. Useful when processing is dominated by waiting for I/O.
         :return: a tuple of the counts of directories and files processed, and the files skipped.
         """
+        workers = kwargs.get('workers', 1) or 1
+        if workers <= 1:
+            return self._process_files(acceptor, processor, **kwargs)
+        futures: List[Future] = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def submit(file_path: Path) -> None:
+                futures.append(executor.submit(processor, file_path))
+
+            n_dirs, n_files, n_skipped, n_missing, n_errors = self._process_files(acceptor, submit, **kwargs)
+        n_errors += sum(1 for f in futures if f.result() is False)
+        return n_dirs, n_files, n_skipped, n_missing, n_errors
+
+    def _process_files(self, acceptor: Callable[[Path], bool], processor: Callable[[Path], Any],
+                       **kwargs) -> Tuple[int, int, int, int, int]:
         verbose = kwargs.get('verbose', 0)
         limit = kwargs.get('limit', 1_000_000_000)
         remaining = kwargs.get('files', self._files)
+        suffix = kwargs.get('suffix')
+        if suffix is not None:
+            suffix = suffix.lower()
         n_files: int = 0
         n_skipped: int = 0
         n_dirs: int = 0
         n_missing: int = 0
         n_errors: int = 0
 
+        # The given files and directories are Paths; the contents of directories are os.DirEntry objects, from
+        # os.scandir, which already know whether they're files or directories without another stat.
+        remaining: Deque[Union[Path, os.DirEntry]] = deque(remaining)
         while len(remaining) > 0:
-            file_spec: Path = remaining.pop()
-            if not file_spec.exists():
-                if file_spec in self._files:
+            entry = remaining.pop()
+            if isinstance(entry, os.DirEntry):
+                is_file = entry.is_file()
+                if is_file and suffix is not None and not entry.name.lower().endswith(suffix):
+                    n_skipped += 1
+                    continue
+                file_spec: Path = Path(entry.path)
+                is_dir = not is_file and entry.is_dir()
+            else:
+                file_spec: Path = entry
+                try:
+                    mode = file_spec.stat().st_mode
+                    is_file = stat.S_ISREG(mode)
+                    is_dir = stat.S_ISDIR(mode)
+                except (FileNotFoundError, NotADirectoryError):
+                    is_file = is_dir = False
+            if not is_file and not is_dir:
+                if file_spec in self._original:
                     print(f'The given file \'{str(file_spec)}\' does not exist')
                 n_missing += 1
-            elif file_spec.is_file():
-                if acceptor(file_spec):
+            elif is_file:
+                if (suffix is None or file_spec.name.lower().endswith(suffix)) and acceptor(file_spec):
                     n_files += 1
                     process_result = processor(file_spec)
                     if process_result is False:
@@ -57,5 +102,14 @@ class FilesProcessor:
                 n_dirs += 1
                 if verbose > 1:
                     print(f'Adding files from directory \'{str(file_spec)}\'.')
-                remaining.extend([f for f in file_spec.iterdir()])
+                # Queue the sub-directories behind the files, so that all of a directory's files are processed
+                # before descending into its sub-directories.
+                with os.scandir(file_spec) as entries:
+                    files: List[os.DirEntry] = []
+                    for dir_entry in entries:
+                        if dir_entry.is_file():
+                            files.append(dir_entry)
+                        else:
+                            remaining.append(dir_entry)
+                remaining.extend(files)
         return n_dirs, n_files, n_skipped, n_missing, n_errors
@@ -0,0 +1,130 @@
+"""
+test_UfBundler.py
+
+Tests the parts of UfBundler that decide what goes into the bundles: the first-fit-decreasing packing of messages
+into bundles, per language; the grouping of already bundled messages by their bundle; and the allocation of the
+bundle uuids.
+"""
+import unittest
+import uuid
+from types import SimpleNamespace
+from typing import List
+from unittest import mock
+
+import UfBundler
+from UfBundler import BundleInfo
+
+
+def uf(message_uuid: str, language: str = 'en', length_bytes: int = 1, length_seconds: int = 10,
+       bundle_uuid: str = None) -> SimpleNamespace:
+    return SimpleNamespace(message_uuid=message_uuid, language=language, length_bytes=length_bytes,
+                           length_seconds=length_seconds, bundle_uuid=bundle_uuid)
+
+
+class BundlerTestCase(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(UfBundler, 'DbUtils')
+        self.db = patch.start().return_value
+        self.addCleanup(patch.stop)
+
+    @staticmethod
+    def make_bundler(max_bytes: int = 100, **kwargs) -> UfBundler.UfBundler:
+        return UfBundler.UfBundler('TEST', 1, max_files=1000, max_bytes=max_bytes, **kwargs)
+
+
+class TestPartition(BundlerTestCase):
+    def test_first_fit_decreasing(self):
+        # In arrival order the two small messages share a bundle, and each large one needs its own; largest first,
+        # each large message has room for a small one.
+        records = [uf('a', length_bytes=10), uf('b', length_bytes=10), uf('c', length_bytes=90),
+                   uf('d', length_bytes=90)]
+        bundles = self.make_bundler()._partition(records)
+        self.assertEqual([[m.message_uuid for m in b.uf_list] for b in bundles], [['c', 'a'], ['d', 'b']])
+        self.assertEqual([b.bytes for b in bundles], [100, 100])
+
+    def test_fills_earlier_bundle_first(self):
+        records = [uf('a', length_bytes=70), uf('b', length_bytes=60), uf('c', length_bytes=30),
+                   uf('d', length_bytes=20)]
+        bundles = self.make_bundler()._partition(records)
+        self.assertEqual([[m.message_uuid for m in b.uf_list] for b in bundles], [['a', 'c'], ['b', 'd']])
+
+    def test_languages_kept_apart(self):
+        records = [uf('a', 'en', 10, 5), uf('b', 'fr', 10, 6), uf('c', 'en', 10, 7), uf('d', 'fr', 10, 8)]
+        bundles = self.make_bundler()._partition(records)
+        self.assertEqual(len(bundles), 2)
+        for bundle in bundles:
+            self.assertTrue(all(m.language == bundle.language for m in bundle.uf_list))
+        by_language = {b.language: b for b in bundles}
+        self.assertEqual(by_language['en'].seconds, 12)
+        self.assertEqual(by_language['fr'].seconds, 14)
+        self.assertEqual(by_language['fr'].bytes, 20)
+
+    def test_oversize_message_gets_its_own_bundle(self):
+        records = [uf('a', length_bytes=150), uf('b', length_bytes=30)]
+        bundles = self.make_bundler()._partition(records)
+        self.assertEqual([[m.message_uuid for m in b.uf_list] for b in bundles], [['a'], ['b']])
+
+    def test_every_message_placed_once(self):
+        records = [uf(str(ix), language=('en', 'fr')[ix % 2], length_bytes=(ix * 37) % 90 + 1) for ix in range(50)]
+        bundles = self.make_bundler()._partition(records)
+        placed = [m.message_uuid for b in bundles for m in b.uf_list]
+        self.assertCountEqual(placed, [r.message_uuid for r in records])
+        self.assertTrue(all(b.bytes <= 100 for b in bundles))
+
+    def test_no_messages(self):
+        self.assertEqual(self.make_bundler()._partition([]), [])
+
+
+class TestGetPartitionedRecords(BundlerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.get_uf_records.return_value = [
+            uf('a', 'en', 10, 5, bundle_uuid='b1'),
+            uf('b', 'en', 20, 6, bundle_uuid='b2'),
+            uf('c', 'en', 30, 7, bundle_uuid='b1'),
+            uf('d', 'fr', 40, 8),
+        ]
+
+    def test_all_bundles(self):
+        bundles = self.make_bundler()._get_partitioned_records()
+        by_uuid = {b.bundle_uuid: b for b in bundles}
+        self.assertEqual(set(by_uuid), {'b1', 'b2'})
+        self.assertEqual([m.message_uuid for m in by_uuid['b1'].uf_list], ['a', 'c'])
+        self.assertEqual(by_uuid['b1'].bytes, 40)
+        self.assertEqual(by_uuid['b1'].seconds, 12)
+        self.assertEqual(by_uuid['b2'].language, 'en')
+
+    def test_selected_bundles(self):
+        bundles = self.make_bundler()._get_partitioned_records(bundle_uuids=['b2', 'unknown'])
+        self.assertEqual([b.bundle_uuid for b in bundles], ['b2'])
+        self.assertEqual([m.message_uuid for m in bundles[0].uf_list], ['b'])
+
+    def test_empty_selection_matches_nothing(self):
+        self.assertEqual(self.make_bundler()._get_partitioned_records(bundle_uuids=[]), [])
+
+
+class TestUpdateWithBundleUuid(BundlerTestCase):
+    def test_uuids_allocated(self):
+        bundles: List[BundleInfo] = [BundleInfo(uf_list=[uf(str(ix))]) for ix in range(20)]
+        self.assertTrue(self.make_bundler(dry_run=True)._update_with_bundle_uuid(bundles))
+        ids = [b.bundle_uuid for b in bundles]
+        self.assertEqual(len(set(ids)), len(ids))
+        for bundle_uuid in ids:
+            self.assertIsInstance(bundle_uuid, str)
+            self.assertEqual(uuid.UUID(bundle_uuid).version, 4)
+        self.db.update_uf_bundles_bulk.assert_not_called()
+
+    def test_messages_updated_with_their_bundle(self):
+        bundles = [BundleInfo(uf_list=[uf('a'), uf('b')]), BundleInfo(uf_list=[uf('c')])]
+        self.db.update_uf_bundles_bulk.return_value = True
+        self.assertTrue(self.make_bundler()._update_with_bundle_uuid(bundles))
+        pairs = self.db.update_uf_bundles_bulk.call_args.kwargs['pairs']
+        self.assertEqual(pairs, [(bundles[0].bundle_uuid, 'a'), (bundles[0].bundle_uuid, 'b'),
+                                 (bundles[1].bundle_uuid, 'c')])
+
+    def test_no_bundles(self):
+        self.assertTrue(self.make_bundler(dry_run=True)._update_with_bundle_uuid([]))
+
+
+if __name__ == '__main__':
+    unittest.main()
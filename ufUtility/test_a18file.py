@@ -0,0 +1,105 @@
+"""
+test_a18file.py
+
+Tests of the decoding of metadata strings, and of A18File's sidecar handling, using a small synthetic .a18 file.
+"""
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Union
+from unittest import mock
+
+import a18file
+from a18file import A18File, BinaryReader, MetadataReader, MD_MESSAGE_UUID_TAG
+
+
+def _md_string(value: Union[str, bytes]) -> bytes:
+    data = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack('<h', len(data)) + data
+
+
+def _md_field(field_id: int, *values: Union[str, bytes]) -> bytes:
+    body = struct.pack('<b', len(values)) + b''.join(_md_string(v) for v in values)
+    return struct.pack('<hl', field_id, len(body)) + body
+
+
+def write_a18(path: Path, fields: list) -> None:
+    """
+    Writes a minimal .a18 file: a length, some "audio", and a metadata block of the given fields.
+    """
+    audio = b'\x01' * 1000
+    metadata = struct.pack('<ll', 1, len(fields)) + b''.join(fields)
+    path.write_bytes(struct.pack('<l', len(audio)) + struct.pack('<h', 16000) + audio[2:] + metadata)
+
+
+class TestDecodeUtf8(unittest.TestCase):
+    @staticmethod
+    def salvage(str_bytes: bytes) -> str:
+        # What an invalid string must decode as: its printable ASCII characters.
+        return ''.join(chr(b) for b in str_bytes if 32 <= b <= 0x7f)
+
+    def test_valid(self):
+        for text in ['', 'Title', 'Tïtle', 'ཀ་ཁ', 'emoji \U0001F600', 'a real \ufffd replacement character']:
+            str_bytes = text.encode('utf-8')
+            self.assertFalse(BinaryReader.is_corrupt(str_bytes, str(str_bytes, 'utf-8', 'replace')))
+            self.assertEqual(BinaryReader.decode_utf8(str_bytes), text)
+            self.assertEqual(BinaryReader.decode_utf8(memoryview(str_bytes)), text)
+
+    def test_truncated_multibyte(self):
+        # 'é' is two bytes; the string ends after the first of them.
+        str_bytes = 'Café'.encode('utf-8')[:-1]
+        self.assertTrue(BinaryReader.is_corrupt(str_bytes, str(str_bytes, 'utf-8', 'replace')))
+        self.assertEqual(BinaryReader.decode_utf8(str_bytes), 'Caf')
+
+    def test_corrupt(self):
+        for str_bytes in [b'en\xff\x05x', b'\xc3(', b'a\xe2\x82b', '\ufffd'.encode('utf-8') + b'\xff']:
+            self.assertTrue(BinaryReader.is_corrupt(str_bytes, str(str_bytes, 'utf-8', 'replace')))
+            self.assertEqual(BinaryReader.decode_utf8(str_bytes), self.salvage(str_bytes))
+
+    def test_corrupt_value_among_valid(self):
+        # The values of a field are decoded together; only the corrupt one is salvaged.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            a18_path = Path(temp_dir, 'message.a18')
+            write_a18(a18_path, [_md_field(1, 'Tïtle', b'tw\xc3o', 'three')])
+            metadata = MetadataReader.read_from_file(a18_path)
+        self.assertEqual(metadata['TITLE'], 'Tïtle;two;three')
+
+
+class TestUpdateSidecar(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = Path(temp_dir.name)
+        patch = mock.patch.object(a18file.dbutils, 'DbUtils')
+        patch.start().return_value.query_recipient_info.return_value = {}
+        self.addCleanup(patch.stop)
+        self.a18_path = self.dir / 'uf_9-0_1.a18'
+        # Values with leading and trailing blanks, which don't survive a trip through the sidecar.
+        write_a18(self.a18_path, [_md_field(0, ' cat '), _md_field(1, 'Title ', 'two')])
+        self.a18_path.with_suffix('.properties').write_text(
+            'RECIPIENTID=abc\nPROJECT=TEST\nDEPLOYMENT_NUMBER=1\ncollection.STATSUUID=1234\n')
+
+    def _update_sidecar(self) -> str:
+        a18 = A18File(self.a18_path)
+        self.assertTrue(a18.update_sidecar())
+        return A18File(self.a18_path).property(MD_MESSAGE_UUID_TAG)
+
+    def test_message_uuid_from_partial_sidecar(self):
+        message_uuid = self._update_sidecar()
+        self.assertTrue(message_uuid)
+        # As if an earlier run was interrupted after saving the metadata, but before the message uuid.
+        sidecar_path = self.a18_path.with_suffix('.properties')
+        lines = sidecar_path.read_text().splitlines()
+        kept = [line for line in lines if not line.startswith(MD_MESSAGE_UUID_TAG + '=')]
+        sidecar_path.write_text('\n'.join(kept) + '\n')
+        self.assertIsNone(A18File(self.a18_path).property(MD_MESSAGE_UUID_TAG))
+        self.assertEqual(self._update_sidecar(), message_uuid)
+
+    def test_message_uuid_kept_on_rerun(self):
+        message_uuid = self._update_sidecar()
+        self.assertEqual(self._update_sidecar(), message_uuid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+test_dbutils.py
+
+Tests that DbUtils.acquire returns its connections to the pool, whether the borrower finishes normally or raises,
+and that a broken connection's slot is reused.
+"""
+import queue
+import threading
+import unittest
+from typing import Any, List
+from unittest import mock
+
+import dbutils
+from dbutils import DbUtils
+
+
+class FakeConnection:
+    def __init__(self, broken: bool = False):
+        self.autocommit = True
+        self.broken = broken
+        self.rollbacks = 0
+
+    def rollback(self):
+        if self.broken:
+            raise Exception('connection is broken')
+        self.rollbacks += 1
+
+
+class TestAcquire(unittest.TestCase):
+    def setUp(self):
+        self.pool = queue.Queue()
+        patches = [mock.patch.object(dbutils, '_db_connections', self.pool),
+                   mock.patch.object(dbutils, '_num_db_connections', 0),
+                   mock.patch.object(DbUtils, '_get_db_parms', return_value={})]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_returned_after_read(self):
+        connection = FakeConnection()
+        with mock.patch.object(dbutils.pg8000, 'connect', return_value=connection):
+            with DbUtils().acquire() as db_connection:
+                self.assertIs(db_connection, connection)
+        self.assertFalse(connection.autocommit)
+        self.assertEqual(connection.rollbacks, 1)
+        self.assertIs(self.pool.get_nowait(), connection)
+        self.assertEqual(dbutils._num_db_connections, 1)
+
+    def test_returned_after_exception(self):
+        connection = FakeConnection()
+        with mock.patch.object(dbutils.pg8000, 'connect', return_value=connection):
+            with self.assertRaises(ValueError):
+                with DbUtils().acquire():
+                    raise ValueError('failed')
+        self.assertEqual(connection.rollbacks, 1)
+        self.assertIs(self.pool.get_nowait(), connection)
+        self.assertEqual(dbutils._num_db_connections, 1)
+
+    def test_reused(self):
+        connection = FakeConnection()
+        self.pool.put(connection)
+        with mock.patch.object(dbutils.pg8000, 'connect') as connect:
+            for _ in range(dbutils.MAX_DB_CONNECTIONS + 1):
+                with DbUtils().acquire() as db_connection:
+                    self.assertIs(db_connection, connection)
+            connect.assert_not_called()
+        self.assertEqual(self.pool.qsize(), 1)
+
+    def test_broken_connection_dropped(self):
+        broken, replacement = FakeConnection(broken=True), FakeConnection()
+        with mock.patch.object(dbutils.pg8000, 'connect', side_effect=[broken, replacement]):
+            with DbUtils().acquire():
+                pass
+            # The broken connection's slot is left in the pool, and the next borrower opens a new connection in it.
+            self.assertIsNone(self.pool.get_nowait())
+            self.pool.put(None)
+            with DbUtils().acquire() as db_connection:
+                self.assertIs(db_connection, replacement)
+        self.assertIs(self.pool.get_nowait(), replacement)
+        self.assertEqual(dbutils._num_db_connections, 1)
+
+    def test_waiter_woken_by_broken_connection(self):
+        broken, replacement = FakeConnection(broken=True), FakeConnection()
+        acquired: List[Any] = []
+        with mock.patch.object(dbutils, 'MAX_DB_CONNECTIONS', 1), \
+                mock.patch.object(dbutils.pg8000, 'connect', side_effect=[broken, replacement]):
+            with DbUtils().acquire():
+                # The pool is full, so the other thread waits for this connection, which fails its rollback.
+                waiter = threading.Thread(target=self._acquire_into, args=(acquired,), daemon=True)
+                waiter.start()
+                waiter.join(0.1)
+                self.assertTrue(waiter.is_alive())
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())
+        self.assertEqual(acquired, [replacement])
+        self.assertIs(self.pool.get_nowait(), replacement)
+        self.assertEqual(dbutils._num_db_connections, 1)
+
+    @staticmethod
+    def _acquire_into(acquired: List[Any]) -> None:
+        with DbUtils().acquire() as db_connection:
+            acquired.append(db_connection)
+
+if __name__ == '__main__':
+    unittest.main()
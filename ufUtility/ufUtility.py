@@ -1,17 +1,24 @@
 import argparse
 import csv
+import functools
+import sys
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple, Union, Any
+from typing import Deque, Tuple, Union, Any
 
 from A18Processor import A18Processor
 from ArgParseActions import StorePathAction, StoreFileExtension
 from UfBundler import UfBundler
 from UfMetadata import UfMetadata
-from a18file import A18File
+from a18file import A18File, MetadataReader
 from dbutils import DbUtils
 from filesprocessor import FilesProcessor
 
+# How many .a18 files the list command reads at once.
+LIST_WORKERS = 16
+
 args: Any = None
 
 dbUtils: DbUtils
@@ -58,16 +65,26 @@ def _do_list_properties_files() -> Tuple[int, int, int, int, int]:
     def acceptor(p: Path) -> bool:
         return p.suffix.lower() == '.a18'
 
+    def write_metadata(future: Future) -> None:
+        metadata = future.result()
+        if metadata:
+            # Each file's metadata is aligned on its own keys, and written with one write.
+            key_width = max(len(k) for k in metadata.keys())
+            sys.stdout.write(''.join([f'{k:>{key_width}} = {v}\n' for k, v in metadata.items()]))
+
     def processor(p: Path) -> None:
-        a18_file = A18File(p, verbose=args.verbose, dry_run=args.dry_run)
-        metadata = a18_file.metadata
-        if metadata is not None:
-            key_width = max([len(k) for k in metadata.keys()])
-            for k, v in metadata.items():
-                print(f'{k:>{key_width}} = {v}')
+        # The files are read on several threads, so that the reads overlap, but written in the order they're
+        # found. Only a few reads are kept waiting, so output starts at once, and memory doesn't grow with the tree.
+        pending.append(executor.submit(MetadataReader.read_from_file, p, args.verbose))
+        if len(pending) >= 2 * LIST_WORKERS:
+            write_metadata(pending.popleft())
 
+    pending: Deque[Future] = deque()
     fp: FilesProcessor = FilesProcessor(args.files)
-    ret = fp.process_files(acceptor, processor, limit=args.limit, verbose=args.verbose)
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        ret = fp.process_files(acceptor, processor, suffix='.a18', limit=args.limit, verbose=args.verbose)
+        while pending:
+            write_metadata(pending.popleft())
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
 
@@ -94,29 +111,42 @@ def _do_create_properties_files() -> Tuple[int, int, int, int, int]:
         ret = a18_file.create_sidecar(**kwargs)
         return ret
 
+    # Only three columns are wanted, so read plain rows, rather than building a dict for each one. The directories
+    # are looked up by their upper case names.
     recipients_map = {}
     with open(args.map, 'r') as recipients_map_file:
-        csvreader = csv.DictReader(recipients_map_file)
+        csvreader = csv.reader(recipients_map_file)
+        header = next(csvreader, [])
+        try:
+            project_ix, directory_ix, recipientid_ix = [header.index(c) for c in ('project', 'directory', 'recipientid')]
+        except ValueError:
+            raise Exception(f'{args.map} must have columns "project", "directory", and "recipientid".')
+        min_len = max(project_ix, directory_ix, recipientid_ix) + 1
         for row in csvreader:
-            if row.get('project') == args.program:
-                recipients_map[row.get('directory')] = row.get('recipientid')
+            if len(row) >= min_len and row[project_ix] == args.program:
+                recipients_map[row[directory_ix].upper()] = row[recipientid_ix]
+    # Look up all of the program's recipients at once, rather than one at a time as the sidecars are created.
+    DbUtils().prefetch_recipients(recipients_map.values())
 
     processor: FilesProcessor = FilesProcessor(args.files)
-    ret = processor.process_files(a18_acceptor, a18_processor, limit=args.limit, verbose=args.verbose)
+    ret = processor.process_files(a18_acceptor, a18_processor, suffix='.a18', limit=args.limit,
+                                  verbose=args.verbose, workers=args.workers)
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
 
 def _do_convert_audio_format() -> Tuple[int, int, int, int, int]:
     global args
     processor: A18Processor = A18Processor(args.files)
-    ret = processor.convert_a18_files(format=args.format, limit=args.limit, verbose=args.verbose)
+    ret = processor.convert_a18_files(format=args.format, limit=args.limit, verbose=args.verbose,
+                                      workers=args.workers)
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
 
 def _do_extract_uf() -> Tuple[int, int, int, int, int]:
     global args
     processor: A18Processor = A18Processor(args.files)
-    ret = processor.extract_uf_files(out_dir=args.out, no_db=args.no_db, format=args.format, limit=args.limit, verbose=args.verbose)
+    ret = processor.extract_uf_files(out_dir=args.out, no_db=args.no_db, format=args.format, limit=args.limit,
+                                     verbose=args.verbose, workers=args.workers)
     propertiesProcessor.commit()
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
@@ -135,14 +165,21 @@ def _do_import_uf_metadata() -> Tuple[int, int, int, int, int]:
     return ret  # n_dirs, n_files, n_skipped, n_missing, n_errors
 
 
-def main():
-    global args, dbUtils, propertiesProcessor
+@functools.lru_cache(maxsize=1)
+def _build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the argument parser, once; it is reused by later calls, as when main() is called from a library or test.
+    :return: the parser.
+    """
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--verbose', '-v', action='count', default=0, help="More verbose output.")
     arg_parser.add_argument('--dry-run', '-n', action='store_true', default=False, help='Don\'t update anything.')
     arg_parser.add_argument('--ffmpeg', action='store_true', help='Use locally installed ffmpeg.')
     arg_parser.add_argument('--limit', type=int, default=999999999,
                             help='Stop after N files. Default is (virtually) unlimited.')
+    arg_parser.add_argument('--workers', type=int, default=None,
+                            help='Process N files at once, for convert, create_properties, and extract_uf. Default '
+                                 'is one at a time for convert and create_properties, one per CPU for extract_uf.')
 
     subparsers = arg_parser.add_subparsers(dest="'Sub-command.'", required=True, help='Command descriptions')
 
@@ -228,7 +265,12 @@ def main():
     arg_parser.add_argument('--db-name', default='dashboard', metavar='DB',
                             help='Optional database name, default "dashboard".')
 
-    args = arg_parser.parse_args()
+    return arg_parser
+
+
+def main():
+    global args, dbUtils, propertiesProcessor
+    args = _build_parser().parse_args()
     if args.verbose > 2:
         print(f'Verbose setting: {args.verbose}.')
     dbArgs = {
@@ -3,7 +3,10 @@ Update dynamodb tables from PostgreSQL.
 """
 import argparse
 import json
-from typing import Optional, Dict
+import random
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, List
 
 import boto3
 import pg8000
@@ -14,6 +17,20 @@ REGION_NAME = 'us-west-2'
 dynamodb = boto3.resource('dynamodb', region_name=REGION_NAME)
 PROGRAMS_TABLE_NAME = 'programs'
 programs_table = dynamodb.Table(PROGRAMS_TABLE_NAME)
+# BatchWriteItem takes at most 25 puts and deletes per request.
+BATCH_WRITE_SIZE = 25
+# How many times to submit a batch's unprocessed items (throttled writes, usually) before giving up on them.
+MAX_BATCH_WRITE_ATTEMPTS = 8
+
+# How many batches to write at once.
+BATCH_WRITE_WORKERS = 8
+
+# DeleteRequests for the programs table, not yet written.
+pending_writes: List[dict] = []
+# The batches, and the updates, are written on these threads, while the scan goes on; the futures' results say
+# if they succeeded.
+write_executor: Optional[ThreadPoolExecutor] = None
+write_futures: List[Future] = []
 
 db_connection: Optional[Connection] = None
 connction_overrides = {}
@@ -111,77 +128,100 @@ def get_programs_from_postgres() -> Dict[str, str]:
     return result
 
 
-def clean_program_name(programid: str) -> bool:
+def write_batch(batch: List[dict]) -> bool:
     """
-    Cleans up the program_name (by deleting the obsolete "description").
-    :param programid: to be cleaned
-    :return: True if successful, False if an exception occurred
+    Writes a batch of requests to the programs table with one BatchWriteItem. Any items that DynamoDB doesn't
+    process (because of throttling) are submitted again, after an exponentially growing, jittered, delay.
+    :param batch: of at most BATCH_WRITE_SIZE DeleteRequests.
+    :return: True if every request was written, False if not.
     """
-    print(f'Cleaning "description" from {programid}...', end='')
-    update_expr = 'REMOVE description'
+    request_items = {PROGRAMS_TABLE_NAME: batch}
+    for attempt in range(MAX_BATCH_WRITE_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(2 ** attempt * 0.05 + random.uniform(0, 0.05))
+        try:
+            response = dynamodb.batch_write_item(RequestItems=request_items)
+        except Exception as err:
+            print(f'exception writing batch of {len(batch)} records: {err}')
+            return False
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return True
+    print(f'{len(request_items[PROGRAMS_TABLE_NAME])} of {len(batch)} records were not written')
+    return False
+
 
+def update_program(programid: str, name: Optional[str], clean: bool) -> bool:
+    """
+    Updates, in place, the program_name for the given programid, and/or removes its obsolete "description". Only
+    those attributes are touched, so nothing else that has changed since the scan is overwritten.
+    :param programid: the program to be updated
+    :param name: the name to be set, or None to leave the name as it is
+    :param clean: if True, remove the "description"
+    :return: True if successful, False if an exception occurred
+    """
+    update_expr = ''
+    expr_values = {}
+    if name is not None:
+        update_expr = 'SET program_name = :n'
+        expr_values[':n'] = name
+    if clean:
+        update_expr += ' REMOVE description'
+    kwargs = {'ExpressionAttributeValues': expr_values} if expr_values else {}
     try:
-        programs_table.update_item(
-            Key={'program': programid},
-            UpdateExpression=update_expr
-        )
+        programs_table.update_item(Key={'program': programid}, UpdateExpression=update_expr.strip(), **kwargs)
     except Exception as err:
-        print(f'exception cleaning record: {err}')
+        print(f'exception updating record for {programid}: {err}')
         return False
-
-    print('ok')
     return True
 
 
-def update_program_name(programid: str, name: str) -> bool:
+def submit_write(fn, *fn_args) -> None:
     """
-    Updates the program_name for the given programid.
-    :param programid: the program to be updated
-    :param name: the name to be set
-    :return: True if successful, False if not
+    Submits a write to be made on the write_executor.
+    :param fn: the function that makes the write, returning True if successful.
+    :param fn_args: its arguments.
     """
-    print(f'Creating or updating name for {programid} as "{name}"...', end='')
-    if not args.dry_run:
-        update_expr = 'SET program_name = :n'
-        expr_values = {
-            ':n': name
-        }
+    global write_executor
+    if write_executor is None:
+        write_executor = ThreadPoolExecutor(max_workers=BATCH_WRITE_WORKERS)
+    write_futures.append(write_executor.submit(fn, *fn_args))
 
-        try:
-            programs_table.update_item(
-                Key={'program': programid},
-                UpdateExpression=update_expr,
-                ExpressionAttributeValues=expr_values
-            )
-        except Exception as err:
-            print(f'exception creating or updating record: {err}')
-            return False
 
-    print('ok')
-    return True
+def flush_writes() -> None:
+    """
+    Submits all of the pending requests, in batches of BATCH_WRITE_SIZE, to be written on the write_executor.
+    """
+    while pending_writes:
+        batch = pending_writes[:BATCH_WRITE_SIZE]
+        del pending_writes[:BATCH_WRITE_SIZE]
+        submit_write(write_batch, batch)
 
 
-def delete_program_record(programid: str) -> bool:
+def await_writes() -> bool:
     """
-    Deletes from dynamodb a program record for programs that no longer exist in PostgreSQL
-    :param programid: to be deleted
-    :return: True if the delete succeeded, False if an exception occurred.
+    Writes any pending requests, and waits for all of the submitted batches and updates to finish.
+    :return: True if every request was written, False if not.
     """
-    if programid == 'TEST':
-        # Special TEST program id.
-        print('NOT deleting special program record for TEST.\nok')
-        return True
+    flush_writes()
+    ok = True
+    for future in as_completed(write_futures):
+        ok = future.result() and ok
+    write_futures.clear()
+    return ok
 
-    print(f'Deleting program record for {programid}')
-    if not args.dry_run:
-        try:
-            programs_table.delete_item(Key={'program': programid})
-        except Exception as err:
-            print(f'exception deleting record: {err}')
-            return False
 
-    print('ok')
-    return True
+def enqueue_write(request: dict) -> None:
+    """
+    Queues a write to the programs table, submitting a batch to be written as soon as there are enough. With
+    --dry-run, nothing is queued.
+    :param request: a {'DeleteRequest': {'Key': ...}}.
+    """
+    if args.dry_run:
+        return
+    pending_writes.append(request)
+    if len(pending_writes) >= BATCH_WRITE_SIZE:
+        flush_writes()
 
 
 def reconcile_programs() -> None:
@@ -202,20 +242,32 @@ def reconcile_programs() -> None:
     for program_item in programs_table.scan()['Items']:
         programid = program_item.get('program')
         if programid not in actual_programs:
+            if programid == 'TEST':
+                # Special TEST program id.
+                print('NOT deleting special program record for TEST.')
+                continue
             print(f'Delete program id {programid}')
-            delete_program_record(programid)
+            enqueue_write({'DeleteRequest': {'Key': {'program': programid}}})
             n_deletes += 1
         else:
             cached_programs.append(programid)
             cached_name = program_item.get('program_name')
             has_obsolete_name = 'description' in program_item
             actual_name = actual_programs[programid]
-            if cached_name != actual_name:
-                print(f'Update name of {programid} from "{cached_name}" to "{actual_name}".')
-                update_program_name(programid, actual_name)
-                n_updates += 1
-            if has_obsolete_name:
-                clean_program_name(programid)
+            if cached_name != actual_name or has_obsolete_name:
+                # A batch can only replace whole items, which could undo other changes made since the scan, so
+                # these are individual updates, made on the write threads.
+                if cached_name != actual_name:
+                    print(f'Update name of {programid} from "{cached_name}" to "{actual_name}".')
+                    n_updates += 1
+                if has_obsolete_name:
+                    print(f'Cleaning "description" from {programid}.')
+                if not args.dry_run:
+                    submit_write(update_program, programid, actual_name if cached_name != actual_name else None,
+                                 has_obsolete_name)
+
+    if not await_writes():
+        print('Not all of the updates and deletions were written.')
 
     # Additions.
     for actual_program in [p for p in actual_programs.keys() if p not in cached_programs]: